@@ -7,30 +7,71 @@ import numpy as np
 
 import time as clock
 import datetime
-import glob
+import contextlib
 import os.path
+import socket
 import json
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 
 import helper as help
 from version import __version__
-from aflare import aflare1
+from aflare import aflare1, aflare_batch, aflare1_ed, FlareSupport
 import detrend
-from fake import ed6890, FlareStats, FakeFlaresDist, FakeCompleteness
+from fake import ed6890, FlareStats, FakeFlaresDist, FakeCompleteness, \
+    FakeCompletenessBoot, LookupCompleteness
 from get import Get
 
-from gatspy.periodic import LombScargleFast
 import warnings
 import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter, correlate
+from scipy.signal import savgol_filter
 
 from matplotlib import rcParams as rcp
 rcp.update({'font.size':12})
 rcp.update({'font.family':'sansserif'})
 
 
+def _runlength(cindx):
+    '''
+    Vectorized version of the reverse loop that used to live in FINDflare:
+
+        for k in range(2, len(cindx)):
+            ConM[-k] = cindx[-k] * (ConM[-(k-1)] + cindx[-k])
+
+    i.e. for every point, the number of consecutive points (itself included)
+    that pass the cuts going forward in the array. As in the loop, the first
+    and last points are never counted.
+
+    Parameters
+    ----------
+    cindx : numpy array
+        1 where a point passes the cuts, 0 otherwise
+
+    Returns
+    -------
+    ConM : numpy array of ints, same length as cindx
+    '''
+    n = len(cindx)
+    ConM = np.zeros(n, dtype='int')
+    if n < 3:
+        return ConM
+
+    ok = np.asarray(cindx) > 0
+    ok[0] = False
+    ok[-1] = False
+
+    # distance from each point to the next point that fails the cuts
+    indx = np.arange(n)
+    fail = np.flatnonzero(~ok)
+    nextfail = fail[np.searchsorted(fail, indx)]
+    ConM[ok] = (nextfail - indx)[ok]
+    return ConM
+
+
 def FINDflare(flux, error, N1=3, N2=1, N3=3,
               avg_std=False, std_window=7,
-              returnbinary=False, debug=False):
+              returnbinary=False, med=None, sig=None, debug=False):
     '''
     The algorithm for local changes due to flares defined by
     S. W. Chang et al. (2015), Eqn. 3a-d
@@ -71,14 +112,25 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
         Should code return the start and stop indicies of flares (default,
         set to False) or a binary array where 1=flares (set to True)
         (Not part of original algorithm)
+    med : float, optional
+        Use this median instead of computing it from flux (Default is None)
+        (Not part of original algorithm)
+    sig : float, optional
+        Use this "sigma" instead of computing it from flux (Default is None)
+        (Not part of original algorithm)
     '''
 
-    med_i = np.nanmedian(flux)
+    if med is None:
+        med_i = np.nanmedian(flux)
+    else:
+        med_i = med
 
     if debug is True:
         print("DEBUG: med_i = {}".format(med_i))
 
-    if avg_std is False:
+    if sig is not None:
+        sig_i = sig
+    elif avg_std is False:
         sig_i = np.nanstd(flux) # just the stddev of the window
     else:
         # take the average of the rolling stddev in the window.
@@ -100,12 +152,9 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
     cindx = np.zeros_like(flux)
     cindx[ctmp] = 1
 
-    # Need to find cumulative number of points that pass "ctmp"
-    # Count in reverse!
-    ConM = np.zeros_like(flux)
-    # this requires a full pass thru the data -> bottleneck
-    for k in range(2, len(flux)):
-        ConM[-k] = cindx[-k] * (ConM[-(k-1)] + cindx[-k])
+    # Need to find cumulative number of points that pass "ctmp",
+    # i.e. how many consecutive candidates follow each point (count in reverse!)
+    ConM = _runlength(cindx)
 
     # these only defined between dl[i] and dr[i]
     # find flare start where values in ConM switch from 0 to >=N3
@@ -121,12 +170,502 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
     if returnbinary is False:
         return istart_i, istop_i
     else:
-        bin_out = np.zeros_like(flux, dtype='int')
-        for k in range(len(istart_i)):
-            bin_out[istart_i[k]:istop_i[k]+1] = 1
+        # flares never overlap, so mark them w/ a cumulative sum of edges
+        edges = np.zeros(len(flux) + 1, dtype='int')
+        np.add.at(edges, istart_i, 1)
+        np.add.at(edges, istop_i + 1, -1)
+        bin_out = np.cumsum(edges[:-1])
         return bin_out
 
-def ModelLC(time, flux, error, mode='davenport', **kwargs):
+def FINDflareStream(flux, error, state=None, N1=3, N2=1, N3=3,
+                    med=None, sig=None, nwarm=None, final=False):
+    '''
+    Run the FINDflare algorithm on a light curve that arrives in chunks,
+    e.g. one quarter at a time, or while tailing a growing file.
+
+    Candidate runs that are still open at the end of a chunk are carried
+    over in "state", and a flare is returned as soon as its run closes.
+    Call once per chunk, passing back the state from the previous call, and
+    set final=True on the last chunk (it may be empty) to close the run
+    that reaches the end of the data.
+
+    FINDflare needs the median and "sigma" of the data. If med and sig are
+    given they are used as-is. Otherwise the first nwarm points are held
+    back until the statistics can be measured from them, and then frozen.
+    With nwarm=None all data is held back until final=True, which is
+    simply FINDflare on the whole light curve.
+
+    The flares found are the same as
+        FINDflare(all_flux, all_error, N1, N2, N3, med=state['med'], sig=state['sig'])
+    on the concatenated data.
+
+    Parameters
+    ----------
+    flux : numpy array
+        the new chunk of data to search over
+    error : numpy array
+        errors corresponding to flux
+    state : dict or None, optional
+        returned by the previous call, None for the first chunk
+    N1, N2, N3 : int, optional
+        Coefficients from original paper, see FINDflare
+    med, sig : float, optional
+        fixed median and stddev to use for the cuts (Default is None)
+    nwarm : int, optional
+        if med/sig are not given, number of points used to measure them
+        (Default is None, i.e. all of the data)
+    final : bool, optional
+        Is this the last chunk of data? (Default is False)
+
+    Returns
+    -------
+    istart, istop : numpy arrays of ints
+        start and stop indices of the flares that closed in this call,
+        counted from the start of the first chunk
+    state : dict
+        to be passed in with the next chunk
+    '''
+    if state is None:
+        state = {'nseen':0, 'runstart':-1, 'med':med, 'sig':sig,
+                 'flux':np.array([]), 'error':np.array([])}
+
+    flux = np.asarray(flux, dtype='float')
+    error = np.asarray(error, dtype='float')
+
+    if (state['med'] is None) or (state['sig'] is None):
+        # still warming up, hold on to the data
+        flux = np.append(state['flux'], flux)
+        error = np.append(state['error'], error)
+        if (final is False) and ((nwarm is None) or (len(flux) < nwarm)):
+            state['flux'], state['error'] = flux, error
+            return np.array([], dtype='int'), np.array([], dtype='int'), state
+
+        if state['med'] is None:
+            state['med'] = np.nanmedian(flux)
+        if state['sig'] is None:
+            state['sig'] = np.nanstd(flux)
+        state['flux'], state['error'] = np.array([]), np.array([])
+
+    med_i, sig_i = state['med'], state['sig']
+    i0 = state['nseen']
+
+    ca = flux - med_i
+    cb = np.abs(flux - med_i) / sig_i
+    cc = np.abs(flux - med_i - error) / sig_i
+
+    # pass cuts from Eqns 3a,b,c
+    cindx = np.array((ca > 0) & (cb > N1) & (cc > N2), dtype='int')
+
+    # as in FINDflare, the 1st point of the light curve is never counted
+    if (i0 == 0) and (len(cindx) > 0):
+        cindx[0] = 0
+
+    # edges of the runs of candidates within this chunk
+    edges = np.diff(np.concatenate(([0], cindx, [0])))
+    rstart = np.flatnonzero(edges == 1) + i0
+    rstop = np.flatnonzero(edges == -1) + i0 # exclusive
+
+    # continue the run left open by the last chunk
+    if state['runstart'] >= 0:
+        if (len(rstart) > 0) and (rstart[0] == i0):
+            rstart[0] = state['runstart']
+        else:
+            rstart = np.append(state['runstart'], rstart)
+            rstop = np.append(i0, rstop)
+
+    i1 = i0 + len(cindx)
+    state['nseen'] = i1
+    state['runstart'] = -1
+
+    # a run that touches the end of the chunk is still open
+    if (len(rstop) > 0) and (rstop[-1] == i1):
+        if final is True:
+            # as in FINDflare, the last point of the light curve is never counted
+            rstop[-1] = i1 - 1
+        else:
+            state['runstart'] = rstart[-1]
+            rstart, rstop = rstart[:-1], rstop[:-1]
+
+    ok = (rstop - rstart) >= N3
+    istart = np.array(rstart[ok], dtype='int')
+    istop = np.array(rstop[ok] - 1, dtype='int')
+
+    return istart, istop, state
+
+
+def FINDflareSweep(flux, error, N1=(3,), N2=(1,), N3=(3,),
+                   avg_std=False, std_window=7):
+    '''
+    Evaluate FINDflare for every combination of the thresholds N1, N2, N3
+    in one go, e.g. to re-tune them on the residuals (flux_diff) that
+    ModelLC returns, without re-running the detrending.
+
+    The median, sigma and the Eqn 3b,c statistics are computed once. Since
+    the run lengths only depend on the N1/N2 cuts, one run-length pass is
+    done per (N1, N2) pair and all N3 values are read off of it.
+
+    Parameters
+    ----------
+    flux : numpy array
+        data to search over, e.g. the flux_diff from ModelLC
+    error : numpy array
+        errors corresponding to data.
+    N1, N2, N3 : lists of ints, optional
+        The grid of coefficients to try, see FINDflare
+    avg_std : bool, optional
+        Compute "sigma" as the median of the rolling().std()
+        (Default is False), see FINDflare
+    std_window : int, optional
+        If avg_std=True, how big of a window should it use? (Default is 7)
+
+    Returns
+    -------
+    counts : numpy array of shape (len(N1), len(N2), len(N3))
+        number of flare candidates found for each combination
+    flares : dict
+        for each (N1, N2, N3) key, the (istart, istop) that FINDflare
+        would return with those thresholds
+    '''
+    N1 = np.atleast_1d(N1)
+    N2 = np.atleast_1d(N2)
+    N3 = np.atleast_1d(N3)
+
+    med_i = np.nanmedian(flux)
+    if avg_std is False:
+        sig_i = np.nanstd(flux)
+    else:
+        sig_i = np.nanmedian(pd.Series(flux).rolling(std_window, center=True).std())
+
+    ca = flux - med_i
+    cb = np.abs(flux - med_i) / sig_i
+    cc = np.abs(flux - med_i - error) / sig_i
+
+    # pass cuts from Eqns 3a,b,c, for all N1 and N2 at once
+    pass1 = (ca > 0)[None, :] & (cb[None, :] > N1[:, None])
+    pass2 = cc[None, :] > N2[:, None]
+
+    counts = np.zeros((len(N1), len(N2), len(N3)), dtype='int')
+    flares = {}
+    for i in range(len(N1)):
+        for j in range(len(N2)):
+            ConM = _runlength(pass1[i] & pass2[j])
+
+            # every run starts where ConM increases, w/ its length at the start
+            rstart = np.where(ConM[0:-1] - ConM[1:] < 0)[0] + 1
+            rlen = ConM[rstart]
+
+            for k in range(len(N3)):
+                ok = rlen >= N3[k]
+                istart_i = np.array(rstart[ok], dtype='int')
+                istop_i = np.array(istart_i + (rlen[ok] - 1), dtype='int')
+                counts[i, j, k] = len(istart_i)
+                flares[(N1[i], N2[j], N3[k])] = (istart_i, istop_i)
+
+    return counts, flares
+
+
+def _segmedian(values, segid, nseg):
+    '''
+    The nanmedian of values within each segment, without looping over segments.
+
+    Parameters
+    ----------
+    values : numpy array
+    segid : numpy array of ints
+        the segment each value belongs to, must be sorted
+    nseg : int
+        the number of segments
+
+    Returns
+    -------
+    numpy array of length nseg, NaN for segments with no finite values
+    '''
+    good = np.isfinite(values)
+    cnt = np.bincount(segid[good], minlength=nseg)
+
+    # sort by value, then (stable) by segment. NaN's end up at the end of
+    # each segment. This is quicker than np.lexsort on big buffers
+    srt = np.argsort(values)
+    srt = values[srt[np.argsort(segid[srt], kind='stable')]]
+    first = np.searchsorted(segid, np.arange(nseg))
+
+    med = np.full(nseg, np.nan)
+    ok = cnt > 0
+    lo = srt[(first + (cnt - 1) // 2)[ok]]
+    hi = srt[(first + cnt // 2)[ok]]
+    med[ok] = (lo + hi) / 2.
+    return med
+
+
+def FINDflareBatch(flux, error, offsets, N1=3, N2=1, N3=3,
+                   avg_std=False, std_window=7):
+    '''
+    Run the FINDflare algorithm over many segments (or light curves) at once.
+
+    The segments are stored end-to-end in one flat buffer, with the
+    boundaries given by offsets. The median and sigma are computed for each
+    segment separately, exactly as FINDflare would, and the candidate runs
+    never cross from one segment to the next.
+
+    Parameters
+    ----------
+    flux : numpy array
+        flat buffer of all the segments to search over
+    error : numpy array
+        errors corresponding to flux
+    offsets : array of ints
+        the boundaries of the segments, i.e. segment j is
+        flux[offsets[j]:offsets[j+1]]. For a light curve split with
+        detrend.FindGaps this is np.append(left, len(time))
+    N1, N2, N3 : int, optional
+        Coefficients from original paper, see FINDflare
+    avg_std : bool, optional
+        Compute "sigma" as the median of the rolling().std() within each
+        segment (Default is False), see FINDflare
+    std_window : int, optional
+        If avg_std=True, how big of a window should it use? (Default is 7)
+
+    Returns
+    -------
+    istart, istop : numpy arrays of ints
+        start and stop indices of flares, in the flat buffer
+    segid : numpy array of ints
+        the segment each flare was found in. Subtract offsets[segid] from
+        istart and istop to get the indices within each segment
+    '''
+    flux = np.asarray(flux, dtype='float')
+    error = np.asarray(error, dtype='float')
+    offsets = np.asarray(offsets, dtype='int')
+    nseg = len(offsets) - 1
+    npts = len(flux)
+
+    seglen = np.diff(offsets)
+    segid = np.repeat(np.arange(nseg), seglen)
+
+    med = _segmedian(flux, segid, nseg)
+
+    if avg_std is False:
+        # population stddev of the finite points, like np.nanstd
+        good = np.isfinite(flux)
+        cnt = np.bincount(segid[good], minlength=nseg)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(segid[good], weights=flux[good], minlength=nseg) / cnt
+            resid = (flux[good] - mean[segid[good]])**2.
+            sig = np.sqrt(np.bincount(segid[good], weights=resid, minlength=nseg) / cnt)
+    else:
+        # centered rolling std, same alignment and ddof as pandas, but
+        # windows are not allowed to straddle two segments
+        rollstd = np.full(npts, np.nan)
+        if npts >= std_window:
+            lo = std_window // 2
+            nwin = npts - std_window + 1
+            # two-pass mean & variance, summed over the (short) window
+            wmean = np.zeros(nwin)
+            for j in range(std_window):
+                wmean += flux[j:j + nwin]
+            wmean /= std_window
+            wvar = np.zeros(nwin)
+            for j in range(std_window):
+                wvar += (flux[j:j + nwin] - wmean)**2.
+            wstd = np.sqrt(wvar / (std_window - 1))
+            wstd[segid[:nwin] != segid[std_window - 1:]] = np.nan
+            rollstd[lo:lo + len(wstd)] = wstd
+        sig = _segmedian(rollstd, segid, nseg)
+
+    med_i = med[segid]
+    sig_i = sig[segid]
+
+    ca = flux - med_i
+    cb = np.abs(flux - med_i) / sig_i
+    cc = np.abs(flux - med_i - error) / sig_i
+
+    # pass cuts from Eqns 3a,b,c
+    cindx = np.zeros(npts, dtype='int')
+    cindx[(ca > 0) & (cb > N1) & (cc > N2)] = 1
+
+    # as in FINDflare, the 1st and last point of each segment are never
+    # counted. This also stops runs from crossing between segments
+    cindx[offsets[:-1][seglen > 0]] = 0
+    cindx[offsets[1:][seglen > 0] - 1] = 0
+
+    ConM = _runlength(cindx)
+
+    istart = np.where((ConM[1:] >= N3) &
+                      (ConM[0:-1] - ConM[1:] < 0))[0] + 1
+    istop = istart + (ConM[istart] - 1)
+
+    return istart, istop, segid[istart]
+
+
+def FlareTemplate(dt, fwhm, tol=1e-6):
+    '''
+    The aflare1 model (unit amplitude) sampled at the cadence of the data,
+    to be used as a matched filter. Only the part of the flare that is
+    non-zero is kept: from 1 FWHM before the peak, until the slow decay
+    term falls below tol.
+
+    Parameters
+    ----------
+    dt : float
+        the cadence of the data
+    fwhm : float
+        the FWHM of the flare template, in the same units as dt
+    tol : float, optional
+        where to truncate the decay, relative to the peak (Default is 1e-6)
+
+    Returns
+    -------
+    npre : int
+        the number of points in the template before the peak
+    template : numpy array
+    '''
+    before, after = FlareSupport(fwhm, tol=tol)
+    npre = int(np.ceil(before / dt))
+    npost = int(np.ceil(after / dt))
+
+    ftime = np.arange(-npre, npost + 1) * dt
+    template = aflare1(ftime, 0., fwhm, 1.)
+    return npre, template
+
+
+# process-wide LRU cache of the flare templates and their spectra.
+# Kepler long and short cadence each have ~1 dt, so it is mostly hits
+_filter_cache = OrderedDict()
+_filter_cache_info = {'hits':0, 'misses':0, 'maxsize':128}
+
+
+def CachedFilter(dt, fwhm, nfft, tol=1e-6):
+    '''
+    Get a FlareTemplate and its FFT from the cache, or make & store them.
+
+    The cache key is (dt, fwhm, nfft, tol), w/ dt and fwhm rounded to 9
+    significant digits so float jitter in the cadence doesn't cause misses.
+    The returned arrays are shared, so they are made read-only.
+
+    Parameters
+    ----------
+    dt : float
+        the cadence of the data
+    fwhm : float
+        the FWHM of the flare template, in the same units as dt
+    nfft : int
+        the length of the FFT. Must be at least the length of the data
+        plus the length of the template
+    tol : float, optional
+        where to truncate the decay, see FlareTemplate
+
+    Returns
+    -------
+    npre : int
+        the number of points in the template before the peak
+    template : numpy array
+        the template, see FlareTemplate
+    spectrum : numpy array
+        the real FFT of the template, wrapped so its peak is at index 0
+    '''
+    key = (float('{:.9g}'.format(dt)), float('{:.9g}'.format(fwhm)), int(nfft), tol)
+
+    if key in _filter_cache:
+        _filter_cache_info['hits'] += 1
+        _filter_cache.move_to_end(key)
+        return _filter_cache[key]
+
+    _filter_cache_info['misses'] += 1
+    npre, template = FlareTemplate(dt, fwhm, tol=tol)
+
+    filt = np.zeros(nfft)
+    filt[0:len(template) - npre] = template[npre:]
+    filt[nfft - npre:] = template[0:npre]
+    spectrum = np.fft.rfft(filt)
+
+    template.flags.writeable = False
+    spectrum.flags.writeable = False
+    _filter_cache[key] = (npre, template, spectrum)
+    if len(_filter_cache) > _filter_cache_info['maxsize']:
+        _filter_cache.popitem(last=False)
+
+    return _filter_cache[key]
+
+
+def FilterCacheInfo(clear=False):
+    '''
+    Report the hits, misses and size of the flare template cache used by
+    CachedFilter.
+
+    Parameters
+    ----------
+    clear : bool, optional
+        empty the cache and reset the counters (Default is False)
+
+    Returns
+    -------
+    dict with the hits, misses, current size and maxsize of the cache
+    '''
+    info = dict(_filter_cache_info, size=len(_filter_cache))
+    if clear is True:
+        _filter_cache.clear()
+        _filter_cache_info['hits'] = 0
+        _filter_cache_info['misses'] = 0
+    return info
+
+
+def MatchedFilterBank(flux, dt, fwhms=None, tol=1e-6, normalize=True):
+    '''
+    Cross-correlate the data with a bank of aflare1 templates of different
+    FWHM, to enhance flare signals of any duration.
+
+    Uses one FFT of the data for all the templates, and the template
+    spectra from CachedFilter. With normalize=True each template is scaled
+    to unit power, so the responses of the different scales can be compared
+    directly, and the best one is kept for every point.
+
+    Parameters
+    ----------
+    flux : numpy array
+        the data to filter, e.g. data - model
+    dt : float
+        the cadence of the data
+    fwhms : list of floats, optional
+        the FWHM of each template, in the same units as dt.
+        (Default is dt * [2, 4, 8, 16, 32])
+    tol : float, optional
+        where to truncate the template decay, see FlareTemplate
+    normalize : bool, optional
+        scale the templates to unit power (Default is True). If False, the
+        templates have unit amplitude
+
+    Returns
+    -------
+    response : numpy array
+        the maximum filter response at each point
+    best_fwhm : numpy array
+        the FWHM of the template w/ the maximum response at each point
+    '''
+    if fwhms is None:
+        fwhms = dt * np.array([2., 4., 8., 16., 32.])
+    fwhms = np.atleast_1d(fwhms)
+
+    # the longest template sets the padding. Use a power of 2 so that
+    # segments of similar length share cached spectra
+    npts = len(flux)
+    before, after = FlareSupport(np.max(fwhms), tol=tol)
+    nmax = np.ceil(before / dt) + np.ceil(after / dt) + 1
+    nfft = int(2**np.ceil(np.log2(npts + nmax)))
+    flux_fft = np.fft.rfft(flux, nfft)
+
+    response = np.zeros((len(fwhms), npts))
+    for k in range(len(fwhms)):
+        _, template, spectrum = CachedFilter(dt, fwhms[k], nfft, tol=tol)
+        response[k] = np.fft.irfft(flux_fft * np.conj(spectrum), nfft)[0:npts]
+        if normalize is True:
+            response[k] = response[k] / np.sqrt(np.sum(template**2.))
+
+    best = np.argmax(response, axis=0)
+    return response[best, np.arange(npts)], fwhms[best]
+
+
+def ModelLC(time, flux, error, mode='davenport', warm=None, returnstate=False,
+            **kwargs):
 
     '''
     Construct a model light curve.
@@ -138,7 +677,21 @@ def ModelLC(time, flux, error, mode='davenport', **kwargs):
     errors : numpy array
     mode : 'davenport' or str
         Defines the method used to construct model light curve
+        ('median', 'boxcar', 'fitsin', 'davenport', 'multiscale', 'savgol',
+        'phasefold'). 'phasefold' is 'davenport' w/ the sine fits replaced
+        by a phase-folded running median (detrend.FitPhaseMedian), for
+        non-sinusoidal variables like RR Lyr and EBs.
+    warm : dict
+        the fitted state of an earlier run on similar data (e.g. before
+        injecting fake flares), as returned w/ returnstate=True. The
+        'davenport', 'multiscale' and 'phasefold' modes then start from its
+        boxcar masks, sine periods (or folding period) and IRLS weights,
+        and only iterate until converged.
+    returnstate : bool
+        If True, also return the fitted state (empty for modes other than
+        'davenport', 'multiscale' and 'phasefold')
     '''
+    state = {}
 
 
     if (mode == 'median'):
@@ -167,30 +720,51 @@ def ModelLC(time, flux, error, mode='davenport', **kwargs):
         flux_diff = flux - flux_model_i
 
 
-    if (mode == 'davenport'):
+    if mode in ('davenport', 'multiscale', 'phasefold'):
         # do iterative rejection and spline fit - like FBEYE did
         # also like DFM & Hogg suggest w/ BART
-        box1 = detrend.MultiBoxcar(time, flux, error,
-                                   kernel=2.0, numpass=2)
-
-        sin1 = detrend.FitSin(time, box1, error, maxnum=5,
-                              maxper=(max(time)-min(time)),
-                              per2=False, debug=kwargs['debug'])
-        box3 = detrend.MultiBoxcar(time, flux - sin1, error, kernel=0.3)
+        if warm is None:
+            warm = {}
         t = np.array(time)
+        if mode == 'phasefold':
+            # one period, and a folded median template instead of sines.
+            # The medians don't need the flares taken out, and the boxcar
+            # would smooth sharp features like eclipses
+            sin1, foldpars = detrend.FitPhaseMedian(time, flux, error,
+                                                    maxper=(max(time)-min(time)),
+                                                    warm=warm.get('fold'),
+                                                    returnpars=True)
+            state = {'fold': foldpars}
+        else:
+            keep1 = detrend.MultiBoxcar(time, flux, error,
+                                        kernel=2.0, numpass=2,
+                                        returnindx=True, keep=warm.get('box1'))
+            box1 = np.interp(t, t[keep1], np.asarray(flux)[keep1])
+
+            sin1, sinpars = detrend.FitSin(time, box1, error, maxnum=5,
+                                           maxper=(max(time)-min(time)),
+                                           per2=False, debug=kwargs['debug'],
+                                           warm=warm.get('sin'), returnpars=True)
+            state = {'box1': keep1, 'sin': sinpars}
+        resid = np.asarray(flux - sin1)
+        keep3 = detrend.MultiBoxcar(time, resid, error, kernel=0.3,
+                                    returnindx=True, keep=warm.get('box3'))
+        box3 = np.interp(t, t[keep3], resid[keep3])
         dt = np.nanmedian(t[1:] - t[0:-1])
         exptime_m = (np.nanmax(time) - np.nanmin(time)) / len(time)
         # ksep used to = 0.07...
-        flux_model_i = detrend.IRLSSpline(time, box3, error, numpass=20,
-                                          ksep=exptime_m*10.,
-                                          debug=kwargs['debug'])
+        flux_model_i, irls = detrend.IRLSSpline(time, box3, error, numpass=20,
+                                                ksep=exptime_m*10.,
+                                                debug=kwargs['debug'],
+                                                weight=warm.get('irls'),
+                                                tol=(1e-3 if 'irls' in warm else None),
+                                                returnweight=True)
         flux_model_i += sin1
-        signalfwhm = dt * 2
-        ftime = np.arange(0, 2, dt)
-        modelfilter = aflare1(ftime, 1, signalfwhm, 1)
-        #Cross-correlate model filter to enhance flare signals
-        flux_diff = correlate(flux - flux_model_i,
-                              modelfilter, mode='same')
+        state.update({'box3': keep3, 'irls': irls})
+
+    if mode in ('davenport', 'multiscale', 'phasefold'):
+        flux_diff = _ModelDiff(time, flux, flux_model_i, mode=mode,
+                               fwhms=kwargs.get('fwhms', None))
 
     if (mode == 'savgol'):
         # fit data with a SAVGOL filter
@@ -201,10 +775,186 @@ def ModelLC(time, flux, error, mode='davenport', **kwargs):
         flux_model_i = savgol_filter(flux, Nsmo, 2, mode='nearest')
         flux_diff = flux - flux_model_i
 
+    if returnstate is True:
+        return flux_model_i, flux_diff, state
     return flux_model_i, flux_diff
 
+
+def _ModelDiff(time, flux, flux_model, mode='davenport', fwhms=None):
+    '''
+    The data - model that ModelLC hands to the flare search. In the
+    'davenport', 'phasefold' and 'multiscale' modes it is cross-correlated
+    w/ flare templates, otherwise it is just the difference.
+    '''
+    if mode not in ('davenport', 'multiscale', 'phasefold'):
+        return flux - flux_model
+
+    t = np.array(time)
+    dt = np.nanmedian(t[1:] - t[0:-1])
+
+    if mode in ('davenport', 'phasefold'):
+        signalfwhm = dt * 2
+        #Cross-correlate model filter to enhance flare signals.
+        # The filter (and its FFT) comes from the template cache
+        flux_diff, _ = MatchedFilterBank(flux - flux_model, dt,
+                                         fwhms=[signalfwhm], normalize=False)
+    else:
+        # same model as 'davenport', but cross-correlate w/ a bank of
+        # flare templates, so long flares are enhanced too
+        flux_diff, _ = MatchedFilterBank(flux - flux_model, dt, fwhms=fwhms)
+
+    return flux_diff
+
+
+def _ModelReach(time, mode='davenport'):
+    '''
+    How far (in units of time) a local change of the flux can move the
+    model of ModelLC: numpass times the kernel of each MultiBoxcar, since
+    every pass widens the reach (and trims the edges) by about a kernel,
+    and for the spline modes the support of the cubic spline basis
+    functions. A window of data shorter than twice this can't be modeled
+    on its own, see _LocalFind.
+    '''
+    if mode in ('davenport', 'multiscale', 'phasefold'):
+        exptime_m = (np.nanmax(time) - np.nanmin(time)) / len(time)
+        return (2 * 2.0 + 3 * 0.3) / 24. + 4 * exptime_m * 10.
+    elif mode == 'fitsin':
+        return (2 * 2.0 + 3 * 0.25) / 24.
+    elif mode == 'boxcar':
+        return 3 * 10.0 / 24.
+    elif mode == 'savgol':
+        return 0.2
+    else:
+        raise ValueError('No local model for mode = {}'.format(mode))
+
+def _FindSegment(time, flux, error, flags, mode='davenport',
+                 gapwindow=0.1, minsep=3, debug=False, warm=None):
+    '''
+    Model and search one continuous observation period for flares.
+    This is the work done for each segment in MultiFind.
+
+    Return:
+    ------------
+    istart_i : numpy array
+        start indices of flares, within the segment
+    istop_i : numpy array
+        stop indices of flares, within the segment
+    flux_model_i : numpy array
+        model light curve of the segment
+    state : dict
+        the fitted state of the model, see ModelLC
+    '''
+    # the bad data points (search where bad < 1)
+    bad = help.FlagCuts(flags, returngood=False)
+
+
+    flux_model_i, flux_diff, state = ModelLC(time, flux, error,
+                                             gapwindow=gapwindow, minsep=minsep,
+                                             mode=mode, debug=debug, warm=warm,
+                                             returnstate=True)
+
+    # run final flare-find on DATA - MODEL
+    isflare = FINDflare(flux_diff, error, N1=3, N2=4, N3=3,
+                        returnbinary=True, avg_std=True)
+
+    istart_i, istop_i, cand1 = _FlareEvents(time, isflare, bad,
+                                            gapwindow=gapwindow, minsep=minsep)
+
+    if debug is True:
+        plt.figure()
+        plt.title('debugging plot')
+        plt.scatter(time, flux_i, alpha=0.5,label='flux')
+        plt.plot(time,flux_model_i, c='black',label='flux model')
+        plt.scatter(time[cand1], flux_i[cand1], c='red',label='flare candidates')
+        plt.legend()
+        plt.show()
+
+    return istart_i, istop_i, flux_model_i, state
+
+
+def _FlareEvents(time, isflare, bad, gapwindow=0.1, minsep=3):
+    '''
+    Turn the flare points of FINDflare in to events: drop the bad points
+    and those within gapwindow of the edges, and combine neighboring
+    points in to the same event.
+
+    Return:
+    ------------
+    istart_i, istop_i : numpy arrays
+        start and stop indices of flares
+    cand1 : numpy array
+        indices of the flare candidate points
+    '''
+    # now pick out final flare candidate points from above
+    cand1 = np.where((bad < 1) & (isflare > 0))[0]
+
+    x1 = np.where((np.abs(time[cand1]-time[-1]) < gapwindow))
+    x2 = np.where((np.abs(time[cand1]-time[0]) < gapwindow))
+    cand1 = np.delete(cand1, x1)
+    cand1 = np.delete(cand1, x2)
+    if (len(cand1) < 1):
+        istart_i = np.array([])
+        istop_i = np.array([])
+    else:
+        # find start and stop index, combine neighboring candidates in to same events
+        istart_i = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
+        istop_i = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
+    # if start & stop times are the same, add 1 more datum on the end
+    to1 = np.where((istart_i-istop_i == 0))
+    if len(to1[0])>0:
+        istop_i[to1] += 1
+
+    return istart_i, istop_i, cand1
+
+
+def _FindSegmentShared(blocks, le, ri, mode='davenport',
+                       gapwindow=0.1, minsep=3, warm=None):
+    '''
+    Worker for MultiFind w/ an executor. The light curve columns are read
+    from, and the model is written to, shared memory blocks instead of
+    being pickled.
+
+    Parameters:
+    ------------
+    blocks : dict
+        for each column, the (shared memory name, dtype, length)
+    le, ri : int
+        the boundaries of the segment to search
+    warm : dict
+        the fitted state to start the model from, see ModelLC
+
+    Return:
+    ------------
+    istart_i, istop_i : numpy arrays
+        start and stop indices of flares, within the segment
+    state : dict
+        the fitted state of the model
+    '''
+    shms = {}
+    cols = {}
+    try:
+        for key, (name, dtype, npts) in blocks.items():
+            shms[key] = shared_memory.SharedMemory(name=name)
+            cols[key] = np.ndarray((npts,), dtype=dtype, buffer=shms[key].buf)
+
+        istart_i, istop_i, flux_model_i, state = _FindSegment(
+            cols['time'][le:ri].copy(), cols['flux'][le:ri].copy(),
+            cols['error'][le:ri].copy(), cols['flags'][le:ri].copy(),
+            mode=mode, gapwindow=gapwindow, minsep=minsep, warm=warm)
+
+        cols['flux_model'][le:ri] = flux_model_i
+    finally:
+        # the views must go before the memory can be closed
+        cols.clear()
+        for shm in shms.values():
+            shm.close()
+
+    return istart_i, istop_i, state
+
+
 def MultiFind(lc, dlr,mode='davenport',
-              gapwindow=0.1, minsep=3, debug=False):
+              gapwindow=0.1, minsep=3, debug=False, executor=None,
+              warm=None, returnstate=False):
     '''
     NOTE:
     This needs to be either
@@ -229,6 +979,18 @@ def MultiFind(lc, dlr,mode='davenport',
 
     debug : False or bool
 
+    executor : None or concurrent.futures.ProcessPoolExecutor
+        If given, the segments are searched in parallel by the executor.
+        The light curve is passed to the workers through shared memory,
+        and the output is identical to the serial search.
+
+    warm : None or list of dicts
+        the fitted model state of each period, from an earlier run on
+        similar data, to start the models from. See ModelLC
+
+    returnstate : False or bool
+        If True, also return the list of fitted model states
+
 
     Return:
     ------------
@@ -238,6 +1000,8 @@ def MultiFind(lc, dlr,mode='davenport',
         stop indices of flares
     flux_model : numpy array
         model light curve
+    states : list of dicts
+        if returnstate is True, the fitted model state of each period
     '''
 
     lc['flux_model'] = 0.
@@ -245,61 +1009,255 @@ def MultiFind(lc, dlr,mode='davenport',
     istop = np.array([], dtype='int')
     flux_model = lc.flux_model.copy().values
 
-    for (le,ri) in dlr:
+    if warm is None:
+        warm = [None] * len(dlr)
+
+    if executor is not None:
+        istart, istop, flux_model, states = _MultiFindParallel(
+            lc, dlr, executor, mode=mode, gapwindow=gapwindow, minsep=minsep,
+            warm=warm)
+        if returnstate is True:
+            return istart, istop, flux_model, states
+        return istart, istop, flux_model
+
+    states = []
+    for (le,ri), warm_i in zip(dlr, warm):
         lct = lc.iloc[le:ri].copy()
         time, flux  = lct.time.values, lct.flux.values,
-        error, flags = lct.error.values, lct.flags.values
+        error, flags = lct.error.values, lct['flags'].values
 
-        # the bad data points (search where bad < 1)
-        bad = help.FlagCuts(flags, returngood=False)
+        istart_i, istop_i, flux_model_i, state = _FindSegment(
+            time, flux, error, flags, mode=mode, gapwindow=gapwindow,
+            minsep=minsep, debug=debug, warm=warm_i)
+        states.append(state)
 
+        #chi2 = chisq(lc.flux.values[le:ri], flux_model_i, error[le:ri])
+        istart = np.array(np.append(istart, istart_i + le), dtype='int')
+        istop = np.array(np.append(istop, istop_i + le), dtype='int')
+        flux_model[le:ri] = flux_model_i
 
-        flux_model_i, flux_diff = ModelLC(time, flux, error,
-                                          gapwindow=gapwindow, minsep=minsep,
-                                          mode=mode, debug=debug)
+    if returnstate is True:
+        return istart, istop, flux_model, states
+    return istart, istop, flux_model
 
-        # run final flare-find on DATA - MODEL
-        isflare = FINDflare(flux_diff, error, N1=3, N2=4, N3=3,
-                            returnbinary=True, avg_std=True)
 
-        # now pick out final flare candidate points from above
-        cand1 = np.where((bad < 1) & (isflare > 0))[0]
+def _MultiFindParallel(lc, dlr, executor, mode='davenport',
+                       gapwindow=0.1, minsep=3, warm=None):
+    '''
+    Dispatch the segments of MultiFind to a process pool, and put the
+    results back together in order. See MultiFind.
+    '''
+    shms = {}
+    blocks = {}
+    try:
+        for key in ['time', 'flux', 'error', 'flags', 'flux_model']:
+            col = np.ascontiguousarray(lc[key].values)
+            shms[key] = shared_memory.SharedMemory(create=True,
+                                                   size=max(1, col.nbytes))
+            np.ndarray(col.shape, dtype=col.dtype, buffer=shms[key].buf)[:] = col
+            blocks[key] = (shms[key].name, col.dtype.str, len(col))
+
+        jobs = [executor.submit(_FindSegmentShared, blocks, le, ri, mode=mode,
+                                gapwindow=gapwindow, minsep=minsep, warm=warm_i)
+                for (le,ri), warm_i in zip(dlr, warm)]
+
+        istart = np.array([], dtype='int')
+        istop = np.array([], dtype='int')
+        states = []
+        for (le,ri), job in zip(dlr, jobs):
+            istart_i, istop_i, state = job.result()
+            states.append(state)
+            istart = np.array(np.append(istart, istart_i + le), dtype='int')
+            istop = np.array(np.append(istop, istop_i + le), dtype='int')
+
+        _, dtype, npts = blocks['flux_model']
+        flux_model = np.ndarray((npts,), dtype=dtype,
+                                buffer=shms['flux_model'].buf).copy()
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return istart, istop, flux_model, states
+
+
+def _LocalFind(lc, dlr, flux_model, tpeak, before, after, mode='davenport',
+               gapwindow=0.1, minsep=3, warm=None):
+    '''
+    Search for flares only around a set of (injected) flares, see
+    FakeFlares. The model is re-fit in a window around each flare, wide
+    enough to reach every point the flare can change, and the given model
+    is patched in elsewhere. FINDflare then only runs on these windows,
+    w/ the median and sigma of the whole period.
 
-        x1 = np.where((np.abs(time[cand1]-time[-1]) < gapwindow))
-        x2 = np.where((np.abs(time[cand1]-time[0]) < gapwindow))
-        cand1 = np.delete(cand1, x1)
-        cand1 = np.delete(cand1, x2)
-        if (len(cand1) < 1):
-            istart_i = np.array([])
-            istop_i = np.array([])
+    Parameters:
+    ------------
+    lc : pandas DataFrame
+        light curve
+    dlr : list of tuples
+        contains boundaries of continuous observation periods
+    flux_model : numpy array
+        the model light curve w/o the flares
+    tpeak, before, after : numpy arrays
+        peak times of the flares, and their extent before and after it
+    mode : 'davenport' or str
+        method for model light curve construction
+    warm : None or list of dicts
+        the fitted model state of each period, see MultiFind. If given,
+        the windows only search for the known sine periods, or keep the
+        folded template in 'phasefold' mode.
+
+    Return:
+    ------------
+    istart, istop : numpy arrays
+        start and stop indices of the flares found in the windows
+    flux_model : numpy array
+        the patched model light curve
+    windows : list of tuples
+        the (start, stop) indices of the re-fit windows
+    '''
+    flux_model = np.array(flux_model, dtype='float', copy=True)
+    istart = np.array([], dtype='int')
+    istop = np.array([], dtype='int')
+    windows = []
+    if warm is None:
+        warm = [None] * len(dlr)
+
+    for (le,ri), warm_i in zip(dlr, warm):
+        time = lc.time.values[le:ri]
+        flux, error = lc.flux.values[le:ri], lc.error.values[le:ri]
+        bad = help.FlagCuts(lc['flags'].values[le:ri], returngood=False)
+
+        k = np.where((tpeak >= time[0]) & (tpeak <= time[-1]))[0]
+        if len(k) == 0:
+            continue
+        reach = _ModelReach(time, mode=mode)
+        if (warm_i is not None) and ('sin' in warm_i):
+            warm_i = {'sin': warm_i['sin']}
+        elif (warm_i is not None) and ('fold' in warm_i):
+            warm_i = {'fold': warm_i['fold']}
         else:
-            # find start and stop index, combine neighboring candidates in to same events
-            istart_i = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
-            istop_i = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
-        # if start & stop times are the same, add 1 more datum on the end
-        to1 = np.where((istart_i-istop_i == 0))
-        if len(to1[0])>0:
-            istop_i[to1] += 1
+            warm_i = None
+
+        # the points each flare can change, merged where they overlap
+        lo = np.searchsorted(time, tpeak[k] - before[k] - reach)
+        hi = np.searchsorted(time, tpeak[k] + after[k] + reach, side='right')
+        order = np.argsort(lo)
+        lo, hi = lo[order], np.maximum.accumulate(hi[order])
+        first = np.append([True], lo[1:] > hi[:-1])
+        last = np.append(first[1:], [True])
+        lo, hi = lo[first], hi[last]
+
+        # re-fit each window w/ a margin, so its own edges don't matter
+        flo = np.searchsorted(time, time[lo] - reach)
+        fhi = np.searchsorted(time, time[hi - 1] + reach, side='right')
+        model_all = None
+        for w in range(len(lo)):
+            if time[fhi[w] - 1] - time[flo[w]] < 2. * reach:
+                # too short for the kernels (e.g. clipped at the edge of
+                # the period), use the model of the whole period instead
+                if model_all is None:
+                    model_all, _ = ModelLC(time, flux, error, mode=mode, debug=False,
+                                           gapwindow=gapwindow, minsep=minsep,
+                                           warm=warm_i)
+                model_w = model_all[flo[w]:fhi[w]]
+            else:
+                model_w, _ = ModelLC(time[flo[w]:fhi[w]], flux[flo[w]:fhi[w]],
+                                     error[flo[w]:fhi[w]], mode=mode, debug=False,
+                                     gapwindow=gapwindow, minsep=minsep, warm=warm_i)
+            flux_model[le+lo[w]:le+hi[w]] = model_w[lo[w]-flo[w]:hi[w]-flo[w]]
+            windows.append((le + lo[w], le + hi[w]))
+
+        # the search thresholds come from the whole period
+        flux_diff = _ModelDiff(time, flux, flux_model[le:ri], mode=mode)
+        med = np.nanmedian(flux_diff)
+        sig = np.nanmedian(pd.Series(flux_diff).rolling(7, center=True).std())
+
+        isflare = np.zeros(len(time), dtype='int')
+        for w in range(len(lo)):
+            isflare[lo[w]:hi[w]] = FINDflare(flux_diff[lo[w]:hi[w]],
+                                             error[lo[w]:hi[w]],
+                                             N1=3, N2=4, N3=3, med=med, sig=sig,
+                                             returnbinary=True)
+
+        istart_i, istop_i, _ = _FlareEvents(time, isflare, bad,
+                                            gapwindow=gapwindow, minsep=minsep)
+        istart = np.array(np.append(istart, istart_i + le), dtype='int')
+        istop = np.array(np.append(istop, istop_i + le), dtype='int')
 
-        if debug is True:
-            plt.figure()
-            plt.title('debugging plot')
-            plt.scatter(time, flux_i, alpha=0.5,label='flux')
-            plt.plot(time,flux_model_i, c='black',label='flux model')
-            plt.scatter(time[cand1], flux_i[cand1], c='red',label='flare candidates')
-            plt.legend()
-            plt.show()
+    return istart, istop, flux_model, windows
 
 
-        #chi2 = chisq(lc.flux.values[le:ri], flux_model_i, error[le:ri])
-        istart = np.array(np.append(istart, istart_i + le), dtype='int')
-        istop = np.array(np.append(istop, istop_i + le), dtype='int')
-        flux_model[le:ri] = flux_model_i
+def _FakePeaks(time, tstart, tstop, nfake, rng):
+    '''
+    Draw random peak times for fake flares from the time array, avoiding
+    the intervals [tstart, tstop] of the real flares. All peaks are drawn
+    at once, and the ones landing on a real flare are re-drawn.
+
+    Parameters:
+    -------------
+    time : numpy array
+    tstart, tstop : numpy arrays
+        start and stop times of the real flares
+    nfake : int
+        number of peak times to draw
+    rng : numpy.random.Generator or np.random
+
+    Returns:
+    ------------
+    t0 : numpy array of peak times
+    '''
+    t0 = rng.choice(time, nfake)
+    if len(tstart) == 0:
+        return t0
+
+    # sort the real flares, and keep track of the latest stop so far in
+    # case any of them overlap
+    srt = np.argsort(tstart)
+    tstart = tstart[srt]
+    tstop = np.maximum.accumulate(tstop[srt])
+
+    bad = _MatchIntervals(t0, tstart, tstop) >= 0
+    while bad.any():
+        t0[bad] = rng.choice(time, np.sum(bad))
+        bad = _MatchIntervals(t0, tstart, tstop) >= 0
+
+    return t0
+
+
+# the columns of the fake flare summary log, written by FakeFlares.
+# Read back w/ help.ReadRecords(outfile, columns=FAKELOG_HEADER)
+FAKELOG_HEADER = ['min_time','max_time','std_dev','nfake','min_amplitude',
+                  'max_amplitude','min_duration','max_duration','tstamp']
+
+
+def _MatchIntervals(t, tstart, tstop):
+    '''
+    For each time in t, find the interval [tstart, tstop] it falls in.
+
+    Parameters:
+    -------------
+    t : numpy array
+        the times to match, e.g. peak times of injected flares
+    tstart, tstop : numpy arrays
+        start and stop times of the intervals, e.g. of the recovered
+        flares. Must be sorted by tstart. If they overlap, pass the
+        running maximum of tstop (only used to test for any match)
+
+    Returns:
+    ------------
+    indx : numpy array of ints
+        index of the matching interval, or -1 if t is not in any
+    '''
+    j = np.searchsorted(tstart, t, side='right') - 1
+    ok = (j >= 0) & (t <= tstop[np.maximum(j, 0)])
+    return np.where(ok, j, -1)
 
-    return istart, istop, flux_model
 
 def FakeFlares(df1, lc, dlr, mode='davenport', gapwindow=0.1, fakefreq=.25, debug=False,
-                savefile=False, outfile='', display=False, verboseout = False):
+                savefile=False, outfile='', display=False, verboseout = False,
+                executor=None, rng=None, binarylog=False, warm=None,
+                local=False, validate=False):
 
     '''
     Create a number of events, inject them in to data
@@ -318,48 +1276,59 @@ def FakeFlares(df1, lc, dlr, mode='davenport', gapwindow=0.1, fakefreq=.25, debu
     gapwindow - =0.1
     fakefreq - = .25, flares per day
     debug - =False
-    savefile - =False
-    outfile - =''
+    savefile - =False, append a summary of the injections to outfile
+    outfile - ='', the log file, see helper.AppendRecord
     display =False
     verboseout =False
+    executor - =None, process pool to run MultiFind with
+    rng - =None, numpy.random.Generator to draw the fakes with (default uses np.random)
+    binarylog - =False, write the summary as binary, instead of a JSON line.
+                The time stamp is then in seconds since the epoch
+    warm - =None, the fitted model states of lc, from MultiFind w/
+           returnstate=True. The light curve w/ the fakes is then modeled
+           starting from them, instead of from scratch
+    local - =False, only re-fit the model, and search for flares, in windows
+            around the fakes. Elsewhere lc.flux_model is used. See _LocalFind.
+            The 'davenport', 'multiscale' and 'phasefold' modes need warm,
+            and only its sine periods (or folding period) are used, so the
+            windows don't each run a periodogram. The 'median' and 'fitsin'
+            modes have no such local model, and re-fit the whole light curve
+    validate - =False, w/ local=True, also re-fit the whole light curve and
+               report the max difference between the two models, as column
+               dmodel (max over the window of each fake)
 
     Returns:
     ------------
     fakeres - DataFrame with ed_fake (injected EDs), rec_fake (bool, recovered
     or not), ed_rec (recovered ED), ed_rec_err (uncertainty of recovered ED),
-    istart_rec, istop_rec (locations of recovered fake flares)
+    istart_rec, istop_rec (locations of recovered fake flares), dur_fake
+    (injected FWHMs), std_fake, dt_fake (noise level and cadence of the
+    segment each fake was injected into, see fake.LookupCompleteness)
 
     '''
 
-    def EquivDur(time, flux):
-        '''
-        Compute the Equivalent Duration of a fake flare.
-        This is the area under the flare, in relative flux units.
-
-        Parameters:
-        -------------
-        time : numpy array
-            units of DAYS
-        flux : numpy array
-            relative flux units
-        Return:
-        ------------
-        p : float
-            equivalent duration of a single event in units of seconds
-        '''
-
-        p = np.trapz(flux, x=(time * 60.0 * 60.0 * 24.0))
-        return p
-
     if debug is True:
         print(str(datetime.datetime.now()) + ' FakeFlares started')
-    fakeres = pd.DataFrame()
+    if rng is None:
+        rng = np.random
+    if local is True:
+        if mode in ('davenport', 'multiscale', 'phasefold'):
+            if warm is None:
+                raise ValueError('FakeFlares w/ local=True needs the warm state '
+                                 'in mode = {}, see MultiFind'.format(mode))
+        elif mode not in ('boxcar', 'savgol'):
+            if debug is True:
+                print('No local model for mode = {}, re-fitting the whole '
+                      'light curve'.format(mode))
+            local = False
     new_flux = np.copy(lc.flux)/lc.flux_model.median()-1.
     nfakesum = int(np.rint(fakefreq * (lc.time.max() - lc.time.min())))
     t0_fake = np.zeros(nfakesum, dtype='float')
     ed_fake = np.zeros(nfakesum, dtype='float')
     dur_fake = np.zeros(nfakesum, dtype='float')
     ampl_fake = np.zeros(nfakesum, dtype='float')
+    std_fake = np.zeros(nfakesum, dtype='float')
+    dt_fake = np.zeros(nfakesum, dtype='float')
     checksum = 0
     for (le,ri) in dlr:
         df2t= lc.iloc[le:ri]
@@ -369,39 +1338,36 @@ def FakeFlares(df1, lc, dlr, mode='davenport', gapwindow=0.1, fakefreq=.25, debu
             print('Inject {} fake flares into a {} datapoint long array.'.format(nfake,ri-le))
         df1t = df1[(df1.istart >= le) & (df1.istop <= ri)]
         medflux = df2t.flux_model.median()# flux needs to be normalized
-        rft = pd.DataFrame({'tstart':df2t.time[df2t.index.isin(df1t.istart)],
-                            'tstop':df2t.time[df2t.index.isin(df1t.istop)]})
-        flags = df2t.flags.values
+        # the real flares. Fake flares should not overlap with them
+        tstart = lc.time.values[df1t.istart.values]
+        tstop = lc.time.values[np.minimum(df1t.istop.values, len(lc.time) - 1)]
+        flags = df2t['flags'].values
         error = df2t.error.values / medflux
         flux = df2t.flux.values / medflux - 1.
         time = df2t.time.values
         std = np.nanmedian(error)
+        std_fake[checksum:checksum+nfake] = std
+        cadence = np.nanmedian(np.diff(time))
+        dt_fake[checksum:checksum+nfake] = cadence
+
+        dur_fake[checksum:checksum+nfake], ampl_fake[checksum:checksum+nfake] = FakeFlaresDist(std, nfake, mode='hawley2014', debug=debug, rng=rng)
+
+        # generate random peak times, avoid known flares
+        t0_fake[checksum:checksum+nfake] = _FakePeaks(time, tstart, tstop, nfake, rng)
+
+        # generate all the fake flares of this segment at once, each only
+        # where it is non-zero, averaged over the exposures (the cadence)
+        fl_flux = aflare_batch(time, t0_fake[checksum:checksum+nfake],
+                               dur_fake[checksum:checksum+nfake],
+                               ampl_fake[checksum:checksum+nfake],
+                               exptime=cadence)
 
-        dur_fake[checksum:checksum+nfake], ampl_fake[checksum:checksum+nfake] = FakeFlaresDist(std, nfake, mode='hawley2014', debug=debug)
-
-
-
-        for k in range(checksum, checksum+nfake):
-    	    # generate random peak time, avoid known flares
-    	    isok = False
-    	    while isok is False:
-    	        # choose a random peak time
-    	        t0 =  np.random.choice(time)
-                # Are there any real flares to deal with?
-    	        if rft.tstart.shape[0]>0:
-                    # Are there any real flares happening at peak time?
-                    # Fake flares should not overlap with real ones.
-                    b = rft[(t0 >= rft.tstart) & (t0 <= rft.tstop)].shape[0]
-                    if b == 0:
-                        isok = True
-    	        else: isok = True
-    	    t0_fake[k] = t0
-    	    # generate the fake flare
-    	    fl_flux = aflare1(time, t0, dur_fake[k], ampl_fake[k])
-
-    	    ed_fake[k] = EquivDur(time, fl_flux)
-    	    # inject flare in to light curve
-    	    new_flux[le:ri] = new_flux[le:ri] + fl_flux
+        # the exact ED of each flare, in seconds
+        ed_fake[checksum:checksum+nfake] = aflare1_ed(dur_fake[checksum:checksum+nfake],
+                                                      ampl_fake[checksum:checksum+nfake])
+
+        # inject flares in to light curve
+        new_flux[le:ri] += fl_flux
         checksum +=nfake
 
     '''
@@ -412,39 +1378,65 @@ def FakeFlares(df1, lc, dlr, mode='davenport', gapwindow=0.1, fakefreq=.25, debu
     #error minimum is a safety net for the spline function if mode=3
     new_lc = pd.DataFrame({'flux':new_flux,'time':lc.time,
                            'error':max(1e-10,np.nanmedian(pd.Series(new_flux).rolling(3, center=True).std())),
-                           'flags':lc.flags})
+                           'flags':lc['flags']})
     # Create a test lightcurve with flares here:
     # out_lc = pd.DataFrame({'flux_raw':new_flux*medflux,'time':lc.time,
     #                        'error':max(1e-10,np.nanmedian(pd.Series(new_flux*medflux).rolling(3, center=True).std())),
-    #                        'flags':lc.flags})
+    #                        'flags':lc['flags']})
     # out_lc.to_csv('test_suite/test/testlc.csv')
-    istart, istop, new_lc['flux_model'] = MultiFind(new_lc, dlr, mode=mode,
-                                          gapwindow=gapwindow, debug=debug)
+    if local is True:
+        # the original model, in the same units as new_flux
+        before, after = FlareSupport(dur_fake)
+        istart, istop, new_lc['flux_model'], windows = _LocalFind(
+            new_lc, dlr, lc.flux_model.values/lc.flux_model.median()-1.,
+            t0_fake, before, after, mode=mode, gapwindow=gapwindow,
+            minsep=3, warm=warm)
+    else:
+        istart, istop, new_lc['flux_model'] = MultiFind(new_lc, dlr, mode=mode,
+                                              gapwindow=gapwindow, debug=debug,
+                                              executor=executor, warm=warm)
 
     h = {'ed_fake':ed_fake,
               'rec_fake': np.zeros(nfakesum) ,'ed_rec':np.zeros(nfakesum),
               'ed_rec_err':np.zeros(nfakesum),'istart_rec':np.zeros(nfakesum),
-              'istop_rec':np.zeros(nfakesum)}
+              'istop_rec':np.zeros(nfakesum),'dur_fake':dur_fake,
+              'std_fake':std_fake,'dt_fake':dt_fake}
+
+    if (local is True) and (validate is True):
+        _, _, full_model = MultiFind(new_lc.copy(), dlr, mode=mode,
+                                     gapwindow=gapwindow, executor=executor)
+        dmodel = np.abs(new_lc.flux_model.values - full_model)
+        if debug is True:
+            print('Max model difference, local vs. full re-fit: {}'.format(np.nanmax(dmodel)))
+        # the window each fake was re-fit in
+        h['dmodel'] = np.zeros(nfakesum)
+        for (wl, wr) in windows:
+            kw = np.where((t0_fake >= lc.time.values[wl]) &
+                          (t0_fake <= lc.time.values[wr - 1]))[0]
+            h['dmodel'][kw] = np.nanmax(dmodel[wl:wr])
 
     if len(istart)>0: # in case no flares are recovered, even after injection
 
-        dfh = pd.DataFrame({'tr':lc.time[istart].values,'ir':lc.time[istart].index.values,
-                            'tp':lc.time[istop].values,'ip':lc.time[istop].index.values})
-        for k in range(nfake): # go thru all recovered flares
-            # do any injected flares overlap recovered flares?
-            rb = dfh[(t0_fake[k] >= dfh.tr) & (t0_fake[k] <= dfh.tp)]
-            if rb.empty==False:
-                rb = rb.iloc[0]
-                h['rec_fake'][k] = 1
-                h['ed_rec'][k], h['ed_rec_err'][k] = help.ED(rb.ir, rb.ip,
-                                                             new_lc, err=True)
-                h['istart_rec'][k], h['istop_rec'][k] = rb.ir, rb.ip
-                istart = np.delete(istart,rb.ir)
-                istop = np.delete(istop,rb.ip)
-
-    df = pd.DataFrame(h)
+        # which recovered flare (if any) does each injected peak fall in?
+        irec = _MatchIntervals(t0_fake, lc.time.values[istart],
+                               lc.time.values[np.minimum(istop, len(lc.time) - 1)])
+
+        # every injected flare inside a recovered one counts as recovered,
+        # even if several of them fall in the same event
+        k = np.where(irec >= 0)[0]
+
+        h['rec_fake'][k] = 1
+        h['ed_rec'][k], h['ed_rec_err'][k] = help.MultiED(istart[irec[k]], istop[irec[k]],
+                                                          new_lc, err=True)
+        h['istart_rec'][k], h['istop_rec'][k] = istart[irec[k]], istop[irec[k]]
+
+        # keep the recovered flares that were not matched to a fake
+        matched = np.unique(irec[k])
+        istart = np.delete(istart, matched)
+        istop = np.delete(istop, matched)
+
+    fakeres = pd.DataFrame(h)
     del h
-    fakeres = fakeres.append(df, ignore_index=True)
 
     if display == True:
         print('Display fake flare injection')
@@ -455,32 +1447,80 @@ def FakeFlares(df1, lc, dlr, mode='davenport', gapwindow=0.1, fakefreq=.25, debu
         plt.close()
 
     if savefile is True:
-        header = ['min_time','max_time','std_dev','nfake','min_amplitude',
-                  'max_amplitude','min_duration','max_duration','tstamp',]
-        if glob.glob(outfile)==[]:
-            dfout = pd.DataFrame()
+        # append this iteration's summary to the log, don't rewrite it
+        if binarylog is True:
+            tstamp = clock.time()
         else:
-            dfout = pd.read_json(outfile)
-
-        tstamp = clock.asctime(clock.localtime(clock.time()))
-        outrow = [[item] for item in [min(time), max(time), std, nfake, min(ampl_fake),
-                                      max(ampl_fake),min(dur_fake),max(dur_fake),tstamp]]
-        dfout = dfout.append(pd.DataFrame(dict(zip(header,outrow))),
-                                 ignore_index=True)
-        dfout.to_json(outfile)
+            tstamp = clock.asctime(clock.localtime(clock.time()))
+        outrow = [float(min(time)), float(max(time)), float(std), int(nfake),
+                  float(min(ampl_fake)), float(max(ampl_fake)),
+                  float(min(dur_fake)), float(max(dur_fake)), tstamp]
+        help.AppendRecord(outfile, dict(zip(FAKELOG_HEADER, outrow)),
+                          binary=binarylog)
 
     #centers of bins, fraction of recovered fake flares per bin, EDs of generated fake flares,
     return fakeres
 
 
 
+def _FakeIteration(df1, lc, dlr, mode, gapwindow, fakefreq, seed, outfile,
+                   warm=None, local=False):
+    '''
+    Worker for the parallel fake flare injection in RunLC: one call of
+    FakeFlares, drawing from a Generator made from seed.
+    '''
+    return FakeFlares(df1, lc, dlr, mode, gapwindow=gapwindow,
+                      fakefreq=fakefreq, rng=np.random.default_rng(seed),
+                      savefile=True, outfile=outfile, warm=warm,
+                      local=local)
+
+
+# where RunLC keeps the shards of the flare list, and their columns
+FLARELIST_DIR = 'flarelist'
+FLARELIST_HEADER = ['Object ID',' Date of Run','Number of Flares','Filename',
+                    'Total Exposure Time of LC in Days','BJD-2454833 days']
+
+
 # objectid = '9726699'  # GJ 1243
 def RunLC(file='', objectid='', lctype='',
           display=False, readfile=False, debug=False, dofake=True,
           dbmode='fits', gapwindow=0.1, maxgap=0.125,
-          fakefreq=.25, mode='davenport', iterations=10):
+          fakefreq=.25, mode='davenport', iterations=10, nproc=1, seed=None,
+          adaptive=False, miniter=10, batch=5, edtol=0.05, nboot=100,
+          lookup=None, warmstart=False, local=False):
     '''
     Main wrapper to obtain and process a light curve
+
+    nproc : number of processes to use (default=1, i.e. serial). The
+            continuous observing periods are searched in parallel, and so
+            are the iterations of the fake flare injection.
+    seed : seed for the fake flare injection (default=None). If given, or
+           if nproc > 1, each iteration draws from its own
+           numpy.random.Generator, spawned from this seed, so the results
+           do not depend on nproc.
+    adaptive : stop the fake flare injection early (default=False). After
+               each batch of iterations, ED68/ED90 and their bootstrap
+               errors are recomputed, and the injection stops once both
+               changed by less than edtol (relative) since the last batch,
+               and both errors are below edtol (relative). `iterations` is
+               then the maximum number of iterations.
+    miniter : minimum number of iterations in adaptive mode (default=10)
+    batch : number of iterations per batch in adaptive mode (default=5).
+            With nproc > 1, up to max(batch, nproc) iterations are run at
+            once, but the convergence is still checked every batch
+            iterations, so the results do not depend on nproc
+    edtol : relative tolerance on ED68/ED90 in adaptive mode (default=0.05)
+    nboot : number of bootstrap resamples in adaptive mode (default=100)
+    lookup : lookup table of past injections, or the .npz file it is saved
+             in, see postprocess.FakeLookupTable (default=None). If given,
+             ED68/ED90 are interpolated from it, and fake flares are only
+             injected if the light curve is not covered by the table.
+    warmstart : model the light curves w/ fake flares starting from the
+                fitted model of the original light curve, instead of from
+                scratch (default=False). See ModelLC
+    local : only re-fit the model around the fake flares (default=False),
+            searching only for the sine periods of the original model.
+            See FakeFlares
     '''
     # get the data
     if debug is True:
@@ -512,35 +1552,117 @@ def RunLC(file='', objectid='', lctype='',
     if debug is True:
         print("dl, dr: {}".format(dlr))
 
-    # uQtr = np.unique(qtr)
-    if debug is True:
-        print(str(datetime.datetime.now()) + ' MultiFind started')
-    istart, istop, lc['flux_model'] = MultiFind(lc,dlr,gapwindow=gapwindow,
-                                                debug=debug, mode=mode)
-
-    df1 = pd.DataFrame({'istart':istart,
-                        'istop':istop,
-                        'ed68':np.full_like(istart,-99),
-                        'ed90':np.full_like(istart,-99)})
-    allfakes = pd.DataFrame()
-    # run artificial flare test in this gap
-
-
-    if dofake is True:
-        dffake = pd.DataFrame()
-        for k in range(iterations):
-            fakeres = FakeFlares(df1, lc, dlr, mode, savefile=True,
-                gapwindow=gapwindow,
-                outfile='{}fake.json'.format(file),
-                display=display, fakefreq=fakefreq, debug=debug)
-            dffake = dffake.append(fakeres, ignore_index=True)
-
-        dffake.to_csv('{}_all_fakes.csv'.format(outfile))
-
-        df1['ed68'], df1['ed90'] = FakeCompleteness(dffake,fakefreq,iterations,
-                                                    display=display,
-                                                    file=objectid)
+    # search the continuous observing periods in parallel? The pool is
+    # shut down when the with block is left, also on errors
+    if nproc > 1:
+        pool = ProcessPoolExecutor(max_workers=nproc)
+    else:
+        pool = contextlib.nullcontext()
 
+    with pool as executor:
+        # uQtr = np.unique(qtr)
+        if debug is True:
+            print(str(datetime.datetime.now()) + ' MultiFind started')
+        istart, istop, lc['flux_model'], states = MultiFind(lc,dlr,gapwindow=gapwindow,
+                                                            debug=debug, mode=mode,
+                                                            executor=executor,
+                                                            returnstate=True)
+        if (warmstart is not True) and (local is not True):
+            states = None
+
+        df1 = pd.DataFrame({'istart':istart,
+                            'istop':istop,
+                            'ed68':np.full_like(istart,-99),
+                            'ed90':np.full_like(istart,-99)})
+        allfakes = pd.DataFrame()
+
+        # interpolate the completeness from past injections, if we can
+        fromtable = False
+        if (dofake is True) and (lookup is not None):
+            ed = LookupCompleteness(lookup,
+                                    np.nanmedian(lc.error.values / lc.flux_model.median()),
+                                    np.nanmedian(np.diff(lc.time.values)), mode=mode)
+            if ed is not None:
+                df1['ed68'], df1['ed90'] = ed
+                fromtable = True
+            elif debug is True:
+                print('Light curve not covered by the lookup table, injecting fakes')
+
+        # run artificial flare test in this gap
+
+
+        if (seed is not None) or (executor is not None):
+            seedseq = np.random.SeedSequence(seed)
+            fakeseeds = seedseq.spawn(iterations)
+            bootrng = np.random.default_rng(seedseq.spawn(1)[0])
+        else:
+            seedseq = None
+            bootrng = None
+
+        niter = 0
+        if (dofake is True) and (fromtable is False):
+            dffake = help.ColumnBuffer()
+            ed_last = None
+            # the iterations submitted to the pool, but not used yet
+            jobs = {}
+            while niter < iterations:
+                # the convergence is always checked after the same
+                # iterations, whatever nproc is
+                if adaptive is True:
+                    krange = range(niter, min(niter + batch, iterations))
+                else:
+                    krange = range(niter, iterations)
+
+                if executor is None:
+                    for k in krange:
+                        if seedseq is None:
+                            rng = None
+                        else:
+                            rng = np.random.default_rng(fakeseeds[k])
+                        fakeres = FakeFlares(df1, lc, dlr, mode, savefile=True,
+                            gapwindow=gapwindow,
+                            outfile='{}fake.jsonl'.format(file),
+                            display=display, fakefreq=fakefreq, debug=debug,
+                            rng=rng, warm=states, local=local)
+                        dffake.extend(fakeres)
+                else:
+                    # one iteration per worker, each w/ a serial MultiFind.
+                    # Keep at least nproc of them going, even past the
+                    # next convergence check
+                    ahead = range(niter, min(niter + max(batch, nproc), iterations))
+                    for k in range(niter, max(krange.stop, ahead.stop)):
+                        if k not in jobs:
+                            jobs[k] = executor.submit(_FakeIteration, df1, lc, dlr, mode,
+                                                      gapwindow, fakefreq, fakeseeds[k],
+                                                      '{}fake.jsonl'.format(file), states,
+                                                      local)
+                    for k in krange:
+                        dffake.extend(jobs.pop(k).result())
+                niter = krange.stop
+
+                if (adaptive is True) and (niter >= miniter):
+                    ed68, ed90, ed68_err, ed90_err = FakeCompletenessBoot(
+                        dffake.to_frame(), fakefreq, niter, nboot=nboot, rng=bootrng)
+                    if debug is True:
+                        print('{} fake iterations: ED68 = {} +/- {}, ED90 = {} +/- {}'
+                              .format(niter, ed68, ed68_err, ed90, ed90_err))
+                    ed_now = np.array([ed68, ed90])
+                    if ((ed_last is not None) and
+                        (ed68_err <= edtol * ed68) and (ed90_err <= edtol * ed90) and
+                        np.all(np.abs(ed_now - ed_last) <= edtol * ed_now)):
+                        break
+                    ed_last = ed_now
+
+            # the iterations past the stopping point are not used
+            for job in jobs.values():
+                job.cancel()
+
+            dffake = dffake.to_frame()
+            dffake.to_csv('{}_all_fakes.csv'.format(outfile))
+
+            df1['ed68'], df1['ed90'] = FakeCompleteness(dffake,fakefreq,niter,
+                                                        display=display,
+                                                        file=objectid)
 
 
     if display is True:
@@ -579,13 +1701,19 @@ def RunLC(file='', objectid='', lctype='',
                  'N_epoch in LC' : str(len(lc.time)),
                  'Total exp time of LC' : str(np.sum(lc.exptime)),
                  }
+    if seedseq is not None:
+        metadata['Fake-Seed'] = str(seedseq.entropy)
+    if fromtable is True:
+        metadata['Fake-Lookup'] = str(lookup)
+    elif dofake is True:
+        metadata['Fake-Iterations'] = str(niter)
 
     if debug is True:
         print(str(datetime.datetime.now()) + 'Getting output header')
 
     header = FlareStats(lc, ReturnHeader=True)
     header = header + ['ED68i','ED90i']
-    dfout = pd.DataFrame()
+    dfout = help.ColumnBuffer(header, capacity=max(1, len(istart)))
 
     if debug is True:
         print(str(datetime.datetime.now()) + 'Getting FlareStats')
@@ -598,30 +1726,24 @@ def RunLC(file='', objectid='', lctype='',
         stats_i = FlareStats(lc, istart=istart[i], istop=istop[i])
 
         stats_i = np.append(stats_i,[df1.ed68.iloc[i],df1.ed90.iloc[i]])
-        stats_i = [[item] for item in stats_i]
-        dfout = dfout.append(pd.DataFrame(dict(zip(header,stats_i))),
-                             ignore_index=True)
+        dfout.append(stats_i)
+    dfout = dfout.to_frame()
     if not dfout.empty:
         dfout.to_csv(outfile + '_flare_stats.csv')
         with open(outfile + '_flare_stats_meta.json','w') as f:
             j = json.dumps(metadata)
             f.write(j)
 
-    #Add the number of flares from this LC to the list
-    flist = 'flarelist.csv'.format(outfile)
-    header = ['Object ID',' Date of Run','Number of Flares','Filename',
-                        'Total Exposure Time of LC in Days','BJD-2454833 days']
-
-    if glob.glob(flist)==[]:
-        dfout = pd.DataFrame()
-    else:
-        dfout = pd.read_csv(flist)
+    #Add the number of flares from this LC to the list.
+    # Each process appends to its own shard, so concurrent jobs never
+    # race on one file. Build the full flarelist.csv w/ postprocess.MergeFlareList
+    if not os.path.isdir(FLARELIST_DIR):
+        os.makedirs(FLARELIST_DIR, exist_ok=True)
+    flist = os.path.join(FLARELIST_DIR, '{}_{}.jsonl'.format(socket.gethostname(), os.getpid()))
 
-    line=[objectid, datetime.datetime.now(), len(istart),file,np.sum(lc.exptime),lc.time[0]]
-    line = [[item] for item in line]
-    dfout = dfout.append(pd.DataFrame(dict(zip(header,line))),
-                             ignore_index=True)
-    dfout.to_csv(flist)
+    line=[str(objectid), str(datetime.datetime.now()), len(istart), file,
+          float(np.sum(lc.exptime)), float(lc.time.values[0])]
+    help.AppendRecord(flist, dict(zip(FLARELIST_HEADER, line)))
     return
 
 # let this file be called from the terminal directly. e.g.:
@@ -2,15 +2,15 @@
 Use this file to keep various detrending methods
 
 '''
+import math
 import numpy as np
 #from pandas import rolling_median #, rolling_mean, rolling_std, rolling_skew
 import pandas as pd
-from scipy.optimize import curve_fit
-from gatspy.periodic import LombScargleFast
-from gatspy.periodic import SuperSmoother
 # import pywt
 from scipy import signal
 from scipy.interpolate import LSQUnivariateSpline, UnivariateSpline
+from scipy.linalg import solveh_banded, LinAlgError
+from scipy.sparse import csc_matrix
 import matplotlib.pyplot as plt
 
 
@@ -248,14 +248,286 @@ def _sinfunc2(t, per1, amp1, t01, per2, amp2, t02, yoff):
     return output
 
 
+def LombScargleGrid(time, error, f0, df, nf, oversampling=2, mfft=6, offsets=None):
+    '''
+    Set up a Lomb Scargle periodogram of the given times and errors on the
+    frequency grid f0 + df * arange(nf), for use w/ LombScarglePower.
+
+    Uses the Press & Rybicki (1989) method, as the LombScargleFast of
+    gatspy does: the sums over the data are extirpolated onto a regular
+    grid and done by FFT. Everything that does not depend on the fluxes
+    (the extirpolation, and the sums over the weights alone) is done here,
+    once, so that periodograms of many fluxes at the same times are cheap.
+
+    With offsets, the data are many segments stored end-to-end (as for
+    appaloosa.FINDflareBatch), each w/ a periodogram of its own. These are
+    all set up together, and done w/ one sparse product and one FFT call.
+
+    Parameters
+    ----------
+    time : 1-d numpy array
+    error : 1-d numpy array
+    f0 : float, or array w/ one per segment
+        the first frequency of the grid
+    df : float, or array w/ one per segment
+        the frequency step of the grid
+    nf : int
+        the number of frequencies
+    oversampling : int, optional
+        the FFT grid oversampling (default=2)
+    mfft : int, optional
+        the number of grid points each datum is extirpolated onto
+        (default=6)
+    offsets : array of ints, optional
+        the boundaries of the (non-empty) segments, i.e. segment j is
+        time[offsets[j]:offsets[j+1]] (default=None, one segment)
+
+    Returns
+    -------
+    dict of the precomputed quantities
+    '''
+    time = np.asarray(time, dtype='float')
+    npts = len(time)
+    if offsets is None:
+        seg_off = np.array([0, npts])
+    else:
+        seg_off = np.asarray(offsets, dtype='int')
+    nseg = len(seg_off) - 1
+    segid = np.repeat(np.arange(nseg), np.diff(seg_off))
+    f0 = np.broadcast_to(np.asarray(f0, dtype='float'), (nseg,))
+    df = np.broadcast_to(np.asarray(df, dtype='float'), (nseg,))
+
+    weight = np.asarray(error, dtype='float')**(-2.)
+    weight = weight / np.bincount(segid, weight, minlength=nseg)[segid]
+    t0 = np.minimum.reduceat(time, seg_off[:-1])
+
+    # the FFT size, a power of 2 covering 2x the grid (for the 2f sums)
+    nfft = 1 << int(np.ceil(np.log2(2 * nf * oversampling)))
+
+    # extirpolation of each datum onto mfft points of the FFT grid of its
+    # segment, as a sparse (nseg * nfft, npts) matrix
+    x = ((time - t0[segid]) * nfft * df[segid]) % nfft
+    isint = (x % 1 == 0)
+    ilo = np.clip((x - mfft // 2).astype(int), 0, nfft - mfft)
+    ind = ilo[None, :] + (mfft - 1 - np.arange(mfft))[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        numer = np.prod(x[None, :] - ilo[None, :] - np.arange(mfft)[:, None], 0)
+        denom = math.factorial(mfft - 1) * np.cumprod(
+            np.r_[1., [j / (j - mfft) for j in range(1, mfft)]])
+        coef = numer[None, :] / (denom[:, None] * (x[None, :] - ind))
+    coef[:, isint] = 0.
+    coef[0, isint] = 1.
+    ind[0, isint] = x[isint].astype(int)
+    cols = np.broadcast_to(np.arange(npts), ind.shape)
+    extir = csc_matrix((coef.ravel(), ((ind + segid * nfft).ravel(), cols.ravel())),
+                       shape=(nseg * nfft, npts))
+
+    grid = {'time': time, 'weight': weight, 't0': t0, 'f0': f0, 'df': df,
+            'nf': nf, 'nfft': nfft, 'extir': extir, 'segid': segid,
+            'offsets': offsets}
+
+    # the sums over the weights alone, at 2f
+    S2, C2 = _TrigSum(grid, weight, factor=2)
+    tan2wt = S2 / C2
+    C2w = 1. / np.sqrt(1. + tan2wt * tan2wt)
+    S2w = tan2wt * C2w
+    grid['Cw'] = np.sqrt(0.5) * np.sqrt(1. + C2w)
+    grid['Sw'] = np.sqrt(0.5) * np.sign(S2w) * np.sqrt(1. - C2w)
+    grid['CC'] = 0.5 * (1. + C2 * C2w + S2 * S2w)
+    grid['SS'] = 0.5 * (1. - C2 * C2w - S2 * S2w)
+    return grid
+
+
+def _TrigSum(grid, h, factor=1):
+    '''
+    sum_j h_j sin(2 pi f t_j), sum_j h_j cos(2 pi f t_j) on the frequency
+    grid (times factor) of each segment, via the extirpolation set up in
+    LombScargleGrid. Returns (nseg, nf) arrays.
+    '''
+    nfft, nf = grid['nfft'], grid['nf']
+    segid, t0 = grid['segid'], grid['t0']
+    f0 = grid['f0'][:, None] * factor
+    df = grid['df'][:, None]
+    # the extirpolation is on the (t - t0) * df grid, so for factor=2 take
+    # every 2nd frequency of it
+    hc = h * np.exp(2j * np.pi * f0[segid, 0] * (grid['time'] - t0[segid]))
+    fft = grid['extir'].dot(hc).reshape(-1, nfft)
+    fft = np.fft.ifft(fft, axis=1)[:, :factor * nf:factor]
+    fft *= np.exp(2j * np.pi * t0[:, None] * (f0 + factor * df * np.arange(nf)))
+    return nfft * fft.imag, nfft * fft.real
+
+
+def LombScarglePower(grid, flux):
+    '''
+    The (standard normalized) Lomb Scargle power of flux, on the grid set
+    up by LombScargleGrid. As LombScargleFast(fit_offset=False) of gatspy,
+    the weighted mean of flux (of each segment) is removed first.
+
+    Parameters
+    ----------
+    grid : dict
+        as returned by LombScargleGrid
+    flux : 1-d numpy array
+
+    Returns
+    -------
+    the power at each frequency of the grid. If the grid was set up w/
+    offsets, a (nseg, nf) array w/ the power of each segment
+    '''
+    weight, segid = grid['weight'], grid['segid']
+    nseg = len(grid['t0'])
+    y = flux - np.bincount(segid, weight * flux, minlength=nseg)[segid]
+    Sh, Ch = _TrigSum(grid, weight * y)
+    YC = Ch * grid['Cw'] + Sh * grid['Sw']
+    YS = Sh * grid['Cw'] - Ch * grid['Sw']
+    YY = np.bincount(segid, weight * y * y, minlength=nseg)[:, None]
+    power = (YC * YC / grid['CC'] + YS * YS / grid['SS']) / YY
+    if grid['offsets'] is None:
+        return power[0]
+    return power
+
+
+def _PeakPeriod(pwr, f0, df, pok):
+    '''
+    The period and power of the highest peak of pwr among the allowed (pok)
+    grid points, refined between the grid points w/ a parabola.
+    Returns (nan, 0) if no grid point is allowed.
+    '''
+    iok = np.flatnonzero(pok)
+    if len(iok) == 0:
+        return np.nan, 0.
+    ipk = iok[np.argmax(pwr[iok])]
+    pp = pwr[ipk]
+    fk = f0 + df * ipk
+    if 0 < ipk < len(pwr) - 1:
+        pl, pr = pwr[ipk - 1], pwr[ipk + 1]
+        if (pl + pr - 2. * pp) < 0:
+            fk = fk + 0.5 * df * (pl - pr) / (pl + pr - 2. * pp)
+    return 1. / fk, pp
+
+
+def LombScargleBatch(time, flux, error, offsets, nper=20000, minper=0.1,
+                     maxper=None, returnpower=False, chunk=2**18):
+    '''
+    Lomb Scargle periodograms of many segments (or light curves) at once,
+    on the same grid as FitSin uses, returning the peak of each.
+
+    The segments are stored end-to-end in one flat buffer, w/ the
+    boundaries given by offsets, as for appaloosa.FINDflareBatch. All the
+    periodograms are set up and evaluated together (see LombScargleGrid),
+    which saves the per-call overhead for light curves w/ many short
+    segments.
+
+    Parameters
+    ----------
+    time : 1-d numpy array
+    flux : 1-d numpy array
+    error : 1-d numpy array
+    offsets : array of ints
+        the boundaries of the segments, i.e. segment j is
+        time[offsets[j]:offsets[j+1]]. For a light curve split with
+        FindGaps this is np.append(left, len(time))
+    nper : int, optional
+        number of frequencies to search over (default=20000)
+    minper : float, optional
+        minimum period to search (default=0.1)
+    maxper : float, or array w/ one per segment, optional
+        maximum period to search. (default=None, the time baseline of each
+        segment, as ModelLC uses)
+    returnpower : bool, optional
+        if True, also return the (nseg, nper) power and the (nseg, nper)
+        periods it is on (default=False)
+    chunk : int, optional
+        the max size of the FFT grids (summed over segments) to set up at
+        once, to bound memory (default=2**18)
+
+    Returns
+    -------
+    (peak period, peak power) arrays, w/ one per segment. Segments w/o
+    any allowed period (or points) get NaN and 0.
+    If returnpower=True, (peak period, peak power, power, period)
+    '''
+    time = np.asarray(time, dtype='float')
+    flux = np.asarray(flux, dtype='float')
+    error = np.asarray(error, dtype='float')
+    offsets = np.asarray(offsets, dtype='int')
+    nseg = len(offsets) - 1
+    seglen = np.diff(offsets)
+
+    pk = np.full(nseg, np.nan)
+    pp = np.zeros(nseg)
+    power = np.zeros((nseg, nper))
+    per = np.full((nseg, nper), np.nan)
+
+    # empty segments are left out
+    ok = np.flatnonzero(seglen > 0)
+    dt = np.zeros(nseg)
+    dt[ok] = (np.maximum.reduceat(time, offsets[ok]) -
+              np.minimum.reduceat(time, offsets[ok]))
+    if maxper is None:
+        maxper = dt
+    maxper = np.broadcast_to(np.asarray(maxper, dtype='float'), (nseg,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df = (1./minper - 1./maxper) / nper
+        f0 = 1./maxper
+    # segments too short to search are skipped
+    ok = ok[np.isfinite(df[ok]) & (df[ok] > 0)]
+
+    nfft = 1 << int(np.ceil(np.log2(4 * nper)))
+    step = max(1, chunk // nfft)
+    for c in range(0, len(ok), step):
+        sg = ok[c:c + step]
+        keep = np.concatenate([np.arange(offsets[j], offsets[j + 1]) for j in sg])
+        grid = LombScargleGrid(time[keep], error[keep], f0[sg], df[sg], nper,
+                               offsets=np.append(0, np.cumsum(seglen[sg])))
+        pwr = LombScarglePower(grid, flux[keep])
+
+        for i, j in enumerate(sg):
+            per[j] = 1. / (f0[j] + df[j] * np.arange(nper))
+            power[j] = pwr[i]
+            pk[j], pp[j] = _PeakPeriod(pwr[i], f0[j], df[j],
+                                       (per[j] < dt[j]) & (per[j] > minper))
+
+    if returnpower is True:
+        return pk, pp, power, per
+    return pk, pp
+
+
+def _LinearSin(time, flux, periods):
+    '''
+    Fit sines at fixed periods, plus an offset, by linear least squares on
+    sin/cos bases. Returns the parameters as used by _sinfunc (or
+    _sinfunc2 for 2 periods), and the model.
+    '''
+    basis = [np.ones_like(time)]
+    for pk in periods:
+        phase = time * 2.0 * np.pi / pk
+        basis.extend([np.sin(phase), np.cos(phase)])
+    basis = np.array(basis).T
+    coef = np.linalg.lstsq(basis, flux, rcond=None)[0]
+
+    pfit = []
+    for i, pk in enumerate(periods):
+        # a sin(x) + b cos(x) = amp sin(x - 2 pi t0 / per)
+        a, b = coef[2*i + 1], coef[2*i + 2]
+        pfit.extend([pk, np.hypot(a, b), np.arctan2(-b, a) * pk / (2.0 * np.pi)])
+    pfit.append(coef[0])
+    return np.array(pfit), basis.dot(coef)
+
+
 def FitSin(time, flux, error, maxnum=5, nper=20000,
            minper=0.1, maxper=30.0, plim=0.25,
-           per2=False, returnmodel=True, debug=False):
+           per2=False, returnmodel=True, debug=False,
+           warm=None, band=0.05, returnpars=False):
     '''
     Use Lomb Scargle to find a periodic signal. If it is significant then fit
     a sine curve and subtract. Repeat this procedure until no more periodic
     signals are found, or until maximum number of iterations has been reached.
 
+    The periodogram is set up once (LombScargleGrid) and re-evaluated on the
+    residuals at each iteration. The sine at the peak period is fit by
+    linear least squares.
+
     Note: this is where major issues were found in the light curve fitting as
     of Davenport (2016), where the iterative fitting was not adequately
     subtracting "pointy" features, such as RR Lyr or EBs. Upgrades to the
@@ -292,77 +564,95 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
         data - model (default=True)
     debug : bool, optional
         used to print out troubleshooting things (default=False)
+    warm : list, optional
+        the fitted sine parameters of an earlier run on similar data, as
+        returned w/ returnpars=True. Only these periods are searched for,
+        each within +/- band (fractional) of the earlier period, on the
+        same frequency grid. (default=None, i.e. a full search)
+    band : float, optional
+        the fractional width of the warm period search (default=0.05)
+    returnpars : bool, optional
+        if True, also return the list of fitted sine parameters
+        (default=False)
 
     Returns
     -------
     If returnmodel=True, output = combined sine model (default=True)
     If returnmodel=False, output = (data - model)
+    If returnpars=True, (output, list of fitted parameters)
     '''
 
-    flux_out = np.array(flux, copy=True)
-    sin_out = np.zeros_like(flux) # return the sin function!
+    time = np.asarray(time, dtype='float')
+    flux_out = np.array(flux, dtype='float', copy=True)
+    sin_out = np.zeros_like(flux_out) # return the sin function!
 
     # total baseline of time window
     dt = np.nanmax(time) - np.nanmin(time)
 
     medflux = np.nanmedian(flux)
     # ti = time[dl[i]:dr[i]]
+    pars = []
+
+    df = (1./minper - 1./maxper) / nper
+    f0 = 1./maxper
+
+    # the frequency grid, and all the periodogram setup that does not
+    # depend on the fluxes, are shared by all the iterations
+    freq = f0 + df * np.arange(nper)
+    per = 1./freq
+    pok = (per < dt) & (per > minper)
+    if not np.any(pok):
+        maxnum = 0
+    else:
+        grid = LombScargleGrid(time, error, f0, df, nper)
+    flux_out -= medflux
 
     for k in range(0, maxnum):
-        # Use Jake Vanderplas faster version!
-        pgram = LombScargleFast(fit_offset=False)
-        pgram.optimizer.set(period_range=(minper,maxper))
-        pgram = pgram.fit(time,
-                          flux_out - medflux,
-                          error)
-
-        df = (1./minper - 1./maxper) / nper
-        f0 = 1./maxper
-        pwr = pgram.score_frequency_grid(f0, df, nper)
-
-        freq = f0 + df * np.arange(nper)
-        per = 1./freq
-
-        pok = np.where((per < dt) & (per > minper))
-        pk = per[pok][np.argmax(pwr[pok])]
-        pp = np.max(pwr)
+        if (warm is not None) and (k >= len(warm)):
+            # all the known periods are refit, nothing more to search for
+            break
+
+        pwr = LombScarglePower(grid, flux_out)
+
+        if warm is None:
+            i0, npk = 0, nper
+        else:
+            # only search the grid around the known period
+            fk = 1. / warm[k][0]
+            i0 = min(nper - 1, max(0, int(np.floor((fk / (1. + band) - f0) / df))))
+            npk = max(1, min(nper, int(np.ceil((fk / (1. - band) - f0) / df))) - i0)
+
+        band_ok = np.zeros(nper, dtype='bool')
+        band_ok[i0:i0 + npk] = pok[i0:i0 + npk]
+        if not np.any(band_ok):
+            # the known period is out of range, there is no peak (pk)
+            break
+        pk, pp = _PeakPeriod(pwr, f0, df, band_ok)
 
         if debug is True:
             print('trial (k): '+str(k)+'.  peak period (pk):'+str(pk)+
                   '.  peak power (pp):'+str(pp))
 
-        # if a period w/ enough power is detected
-        if (pp > plim):
-            # fit sin curve to window and subtract
-            if per2 is True:
-                p0 = [pk, 3.0 * np.nanstd(flux_out-medflux), 0.0,
-                      pk/2., 1.5 * np.nanstd(flux_out-medflux), 0.1, 0.0]
-                try:
-                    pfit, pcov = curve_fit(_sinfunc2, time, flux_out-medflux, p0=p0)
-                    if debug is True:
-                        print('>>', pfit)
-                except RuntimeError:
-                    pfit = [pk, 0., 0., 0., 0., 0., 0.]
-                    if debug is True:
-                        print('Curve_Fit2 no good')
-
-                flux_out = flux_out - _sinfunc2(time, *pfit)
-                sin_out = sin_out + _sinfunc2(time, *pfit)
-
-            else:
-                p0 = [pk, 3.0 * np.nanstd(flux_out-medflux), 0.0, 0.0]
-                try:
-                    pfit, pcov = curve_fit(_sinfunc, time, flux_out-medflux, p0=p0)
-                except RuntimeError:
-                    pfit = [pk, 0., 0., 0.]
-                    if debug is True:
-                        print('Curve_Fit no good')
-
-                flux_out = flux_out - _sinfunc(time, *pfit)
-                sin_out = sin_out + _sinfunc(time, *pfit)
-
-        # add the median flux for this window BACK in
-        sin_out = sin_out + medflux
+        # stop once no period w/ enough power is left
+        if (pp <= plim):
+            break
+
+        # fit sin curve at the peak period, by linear least squares, and
+        # subtract from the residuals
+        if per2 is True:
+            pfit, model_k = _LinearSin(time, flux_out, [pk, pk/2.])
+        else:
+            pfit, model_k = _LinearSin(time, flux_out, [pk])
+        if debug is True:
+            print('>>', pfit)
+
+        flux_out -= model_k
+        sin_out += model_k
+        pars.append(pfit)
+
+    # add the median flux for this window BACK in
+    sin_out += medflux
+    flux_out += medflux
 
     # if debug is True:
     #     plt.figure()
@@ -371,9 +661,13 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
     #     plt.show()
 
     if returnmodel is True:
-        return sin_out
+        output = sin_out
     else:
-        return flux_out
+        output = flux_out
+
+    if returnpars is True:
+        return output, pars
+    return output
 
 
 '''
@@ -417,9 +711,181 @@ def FitMedSin(time, flux, error, nper=20000,
 '''
 
 
+def _PhaseMedian(phase, flux, nbin, nsmooth=3, srt=None):
+    '''
+    The median of flux in each of nbin bins of phase (in [0, 1)), smoothed
+    w/ a circular running median over nsmooth bins. Empty bins are
+    interpolated over. All bins are done at once, by sorting. srt is
+    np.argsort(flux), if already known.
+    '''
+    ibin = np.minimum((phase * nbin).astype(int), nbin - 1)
+    cnt = np.bincount(ibin, minlength=nbin)
+
+    # sort by flux, then (stable) by bin: the fluxes of each bin in order.
+    # The stable sort of small ints is a radix sort
+    if srt is None:
+        srt = np.argsort(flux)
+    if nbin < 2**15:
+        ibin = ibin.astype('int16')
+    srt = flux[srt[np.argsort(ibin[srt], kind='stable')]]
+    first = np.cumsum(cnt) - cnt
+
+    med = np.full(nbin, np.nan)
+    ok = cnt > 0
+    med[ok] = (srt[(first + (cnt - 1) // 2)[ok]] + srt[(first + cnt // 2)[ok]]) / 2.
+    center = (np.arange(nbin) + 0.5) / nbin
+    if not np.all(ok):
+        med = np.interp(center, center[ok], med[ok], period=1.)
+
+    if nsmooth > 1:
+        lead = nsmooth // 2
+        wrap = np.concatenate((med[nbin - lead:], med, med[:nsmooth - 1 - lead]))
+        med = np.median(wrap[np.arange(nbin)[:, None] + np.arange(nsmooth)], axis=1)
+    return med
+
+
+def _PhaseModel(time, pars):
+    '''
+    Evaluate the phase-folded template of FitPhaseMedian at time
+    '''
+    if not np.isfinite(pars['period']):
+        return np.zeros_like(time) + pars['template'][0]
+    nbin = len(pars['template'])
+    phase = np.mod((time - pars['t0']) / pars['period'], 1.)
+    return np.interp(phase, (np.arange(nbin) + 0.5) / nbin, pars['template'],
+                     period=1.)
+
+
+def FitPhaseMedian(time, flux, error, nper=20000, minper=0.1, maxper=30.0,
+                   plim=0.25, nbin=200, nsmooth=3, maxharm=4, warm=None,
+                   returnmodel=True, returnpars=False):
+    '''
+    Model the periodic variability by the running median of the light curve,
+    folded on its Lomb Scargle period. Unlike the sine fits of FitSin, this
+    follows "pointy" or non-sinusoidal shapes, such as RR Lyr or EBs.
+
+    The periodogram is computed once, on the same grid as FitSin. As Lomb
+    Scargle tends to peak at a harmonic of non-sinusoidal signals (e.g. at
+    half the period of EBs), multiples of the peak period are tried too,
+    and used if they fold clearly better (mean absolute residuals < 0.9
+    times). The template is the median in nbin phase bins, smoothed over
+    nsmooth bins, and interpolated in phase.
+
+    Parameters
+    ----------
+    time : 1-d numpy array
+    flux : 1-d numpy array
+    error : 1-d numpy array
+    nper : int, optional
+        number of periods to search over with Lomb Scargle
+        (default=20000)
+    minper : float, optional
+        minimum period to search (default=0.1)
+    maxper : float, optional
+        maximum period to search (default=30.0)
+    plim : float, optional
+        the fraction of the variance (from the mean absolute deviations)
+        the folded template has to explain to be "significant". Else the
+        model is the median flux (default=0.25)
+    nbin : int, optional
+        the number of phase bins, at most 1/10 of the number of points
+        (default=200)
+    nsmooth : int, optional
+        the number of phase bins to smooth the medians over (default=3)
+    maxharm : int, optional
+        the multiples of the peak period to try (default=4)
+    warm : dict, optional
+        the fitted template of an earlier run on similar data, as returned
+        w/ returnpars=True. Its period is used, w/o a search. If the data
+        cover less than two periods, the template itself is used, w/ an
+        offset and scale fit to the data. (default=None)
+    returnmodel : bool, optional
+        if True, return the model. If False, return the data - model
+        (default=True)
+    returnpars : bool, optional
+        if True, also return the fitted template, as a dict of the period,
+        the phase zero-point t0, and the template values (default=False)
+
+    Returns
+    -------
+    If returnmodel=True, output = the template model
+    If returnmodel=False, output = (data - model)
+    If returnpars=True, (output, fitted template)
+    '''
+    time = np.asarray(time, dtype='float')
+    flux = np.asarray(flux, dtype='float')
+    dt = np.nanmax(time) - np.nanmin(time)
+    medflux = np.nanmedian(flux)
+    good = np.isfinite(flux)
+
+    t0 = np.nanmin(time)
+    nb = int(max(nsmooth, min(nbin, np.sum(good) // 10)))
+
+    # too short to fold, see below
+    short = (warm is not None) and not (dt >= 2. * warm['period'])
+
+    trial = []
+    if warm is not None:
+        if not short:
+            trial = [warm['period']]
+    else:
+        # the Lomb Scargle peak, and its multiples: for "pointy" shapes the
+        # peak is often a harmonic
+        df = (1./minper - 1./maxper) / nper
+        f0 = 1./maxper
+        # (folding needs at least 2 cycles, or any trend folds well)
+        per = 1. / (f0 + df * np.arange(nper))
+        pok = (per < dt / 2.) & (per > minper)
+        if np.any(pok) and (np.sum(good) > nb):
+            grid = LombScargleGrid(time[good], error[good], f0, df, nper)
+            pwr = LombScarglePower(grid, flux[good] - medflux)
+            pk, _ = _PeakPeriod(pwr, f0, df, pok)
+            trial = [pk * k for k in range(1, maxharm + 1) if 2. * pk * k < dt]
+
+    # fold on each trial period. A longer period has to fold clearly
+    # better to be used
+    pars = {'period': np.nan, 't0': t0, 'template': np.array([medflux])}
+    tg, fg = time[good], flux[good]
+    srt = np.argsort(fg)
+    mad0 = np.mean(np.abs(fg - medflux))
+    mad = mad0
+    for k, pt in enumerate(trial):
+        phase = np.mod((tg - t0) / pt, 1.)
+        pars_k = {'period': pt, 't0': t0,
+                  'template': _PhaseMedian(phase, fg, nb, nsmooth=nsmooth, srt=srt)}
+        mad_k = np.mean(np.abs(fg - _PhaseModel(tg, pars_k)))
+        if (k == 0) or (mad_k < 0.9 * mad):
+            pars, mad = pars_k, mad_k
+
+    if (warm is None) and not (1. - (mad / mad0)**2. > plim):
+        # the folded variability is not significant
+        pars = {'period': np.nan, 't0': t0, 'template': np.array([medflux])}
+
+    model = _PhaseModel(time, pars)
+
+    if short and np.isfinite(warm['period']):
+        # use the earlier template, w/ an offset and scale fit to this data
+        # (e.g. if it has been normalized since)
+        pars = warm
+        model = _PhaseModel(time, pars)
+        if np.sum(good) > 1:
+            basis = np.vstack((np.ones(np.sum(good)), model[good])).T
+            coef = np.linalg.lstsq(basis, flux[good], rcond=None)[0]
+            model = coef[0] + coef[1] * model
+
+    if returnmodel is True:
+        output = model
+    else:
+        output = flux - model
+
+    if returnpars is True:
+        return output, pars
+    return output
+
+
 def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
                 sigclip=5, pcentclip=5, returnindx=False,
-                debug=False):
+                debug=False, keep=None):
     '''
     Boxcar smoothing with multi-pass outlier rejection. Uses both errors
     and local scatter for rejection Uses Pandas rolling median filter.
@@ -441,10 +907,16 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
         (Default is 5)
     debug : bool, optional
         used to print out troubleshooting things (default=False)
+    keep : 1-d numpy array, optional
+        indices of the points to start from, e.g. as returned w/
+        returnindx=True by an earlier run on similar data. The passes then
+        stop as soon as no more points are rejected. If empty, it is
+        ignored and all the passes are run. (default=None)
 
     Returns
     -------
     The smoothed light curve model
+    If returnindx=True, the indices of the points the model is built from
     '''
 
     # flux_sm = np.array(flux, copy=True)
@@ -459,11 +931,9 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
     #This is annoying: https://pandas.pydata.org/pandas-docs/stable/gotchas.html#byte-ordering-issues
     #flux = flux.byteswap().newbyteorder()
 
-    flux_i = pd.DataFrame({'flux':flux,'error_i':error,'time_i':time})
-    time_i = np.array(time)
-    #flux_i = pd.Series(flux)
-    error_i = error
-    indx_i = np.arange(len(time)) # for tracking final indx used
+    time_i = np.asarray(time, dtype='float')
+    flux_a = np.asarray(flux, dtype='float')
+    error_a = np.asarray(error, dtype='float')
     exptime = np.nanmedian(time_i[1:]-time_i[:-1])
 
     nptsmooth = int(kernel/24.0 / exptime)
@@ -474,39 +944,58 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
     if debug is True:
         print('# of smoothing points: '+str(nptsmooth))
 
+    # the points still in use, in order. Rather than re-building the data
+    # each pass, only this index shrinks
+    indx_i = np.arange(len(time_i))
+    if (keep is not None) and (len(keep) == 0):
+        # nothing to start from
+        keep = None
+    if keep is not None:
+        # the edges are trimmed in every pass, so put them back
+        keep = np.sort(keep)
+        indx_i = np.concatenate((np.arange(keep[0]), keep,
+                                 np.arange(keep[-1] + 1, len(time_i))))
+    finite = np.isfinite(flux_a) & np.isfinite(error_a) & np.isfinite(time_i)
+
+    # rolling median in this data span with the kernel size
+    flux_i_sm = RollingMedian(flux_a[indx_i], nptsmooth)
+
     # now take N passes of rejection on it
     for k in range(0, numpass):
-        # rolling median in this data span with the kernel size
-        flux_i['flux_i_sm'] = flux_i.flux.rolling(nptsmooth, center=True).median()
-        #indx = np.isfinite(flux_i_sm)
-        flux_i = flux_i.dropna(how='any')
+        # drop the points w/o a median (the edges, and next to NaN's)
+        indx_all = indx_i
+        good = np.isfinite(flux_i_sm) & finite[indx_i]
+        indx_i, flux_i_sm = indx_i[good], flux_i_sm[good]
+        # which of indx_all are still in use, to find the dropped ones
+        kept = good
 
-        if (flux_i.shape[0] > 1):
-            #diff_k = (flux_i[indx] - flux_i_sm[indx])
-            flux_i['diff_k'] = flux_i.flux-flux_i.flux_i_sm
-            lims = np.nanpercentile(flux_i.diff_k, (pcentclip, 100-pcentclip))
+        if (len(indx_i) > 1):
+            diff_k = flux_a[indx_i] - flux_i_sm
+            lims = np.nanpercentile(diff_k, (pcentclip, 100-pcentclip))
 
             # iteratively reject points
             # keep points within sigclip (for phot errors), or
             # within percentile clip (for scatter)
-            #ok = np.logical_or((np.abs(diff_k / error_i[indx]) < sigclip),
-                              # (lims[0] < diff_k) * (diff_k < lims[1]))
-            ok = np.logical_or((np.abs(flux_i.diff_k / flux_i.error_i) < sigclip),
-                               (lims[0] < flux_i.diff_k) * (flux_i.diff_k < lims[1]))
+            ok = np.logical_or((np.abs(diff_k / error_a[indx_i]) < sigclip),
+                               (lims[0] < diff_k) * (diff_k < lims[1]))
             if debug is True:
                 print('k = '+str(k))
-                print('number of accepted points: '+str(len(ok[0])))
+                print('number of accepted points: '+str(np.sum(ok)))
 
-            #time_i = time_i[indx][ok]
-            #flux_i = flux_i[indx][ok]
-            #error_i = error_i[indx][ok]
-            #indx_i = indx_i[indx][ok]
-            flux_i = flux_i[ok]
+            if (keep is not None) and np.all(ok):
+                break
+            indx_i, flux_i_sm = indx_i[ok], flux_i_sm[ok]
+            kept[good] = ok
 
+        if k < numpass - 1:
+            # only the windows that held a dropped point change. (The
+            # masks give the dropped points w/o the cost of np.setdiff1d)
+            flux_i_sm = RollingMedian(flux_a[indx_i], nptsmooth, prev=flux_i_sm,
+                                      dropped=indx_all[~kept], indx=indx_i)
 
-    flux_sm = np.interp(time, flux_i.time_i, flux_i.flux)
+    flux_sm = np.interp(time, time_i[indx_i], flux_a[indx_i])
 
-    indx_out = flux_i.index.values
+    indx_out = indx_i
 
     if returnindx is False:
         return flux_sm
@@ -514,7 +1003,126 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
         return np.array(indx_out, dtype='int')
 
 
-def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=False):
+def RollingMedian(values, window, prev=None, dropped=None, indx=None, chunk=2**20):
+    '''
+    Centered rolling median, as pandas rolling(window, center=True).median():
+    NaN where the window is incomplete, or holds a NaN.
+
+    Used by MultiBoxcar, where each pass drops some points from the data.
+    Only the medians of the windows that held a dropped point then have to
+    be re-computed, the others are taken from the previous pass. If too
+    many windows changed, everything is re-computed w/ the (skiplist)
+    rolling median of pandas instead. That is the usual case for the
+    longer kernels at short cadence, where nearly every window holds a
+    dropped point.
+
+    Parameters
+    ----------
+    values : 1-d numpy array
+    window : int
+        the number of points in the window
+    prev : 1-d numpy array, optional
+        the medians of the previous pass, at the points still in values
+    dropped : 1-d numpy array, optional
+        the (sorted) indices of the points dropped since the previous pass
+    indx : 1-d numpy array, optional
+        the indices of values, in the same numbering as dropped
+    chunk : int, optional
+        the max number of points to gather at once, to bound memory
+        (Default is 2**20)
+
+    Returns
+    -------
+    The rolling median
+    '''
+    npts = len(values)
+    lead = window // 2
+    tail = window - 1 - lead
+
+    out = np.full(npts, np.nan)
+    if npts < window:
+        return out
+
+    # the points w/ a complete window
+    where = np.arange(lead, npts - tail)
+    if prev is not None:
+        out[where] = prev[where]
+        # did the window of the point span any dropped point?
+        ndrop = (np.searchsorted(dropped, indx[where + tail]) -
+                 np.searchsorted(dropped, indx[where - lead]))
+        where = where[ndrop > 0]
+
+    if len(where) * window > 4 * npts:
+        return pd.Series(values).rolling(window, center=True).median().values
+
+    offset = np.arange(window) - lead
+    step = max(1, chunk // window)
+    for c in range(0, len(where), step):
+        w = where[c:c + step]
+        out[w] = np.median(values[w[:, None] + offset], axis=1)
+    return out
+
+
+def BSplineBasis(x, knots, order=3):
+    '''
+    The non-zero B-spline basis functions at each x, by the Cox-de Boor
+    recursion done for all points at once.
+
+    Parameters
+    ----------
+    x : 1-d numpy array
+        sorted, within [knots[order], knots[-order-1]]
+    knots : 1-d numpy array
+        the full knot vector, w/ the order+1 repeated end knots
+    order : int, optional
+        the spline order (default is 3)
+
+    Returns
+    -------
+    (first, basis): the index of the first non-zero basis function at
+    each x, and the (len(x), order+1) values of the non-zero ones
+    '''
+    ncoef = len(knots) - order - 1
+    mu = np.searchsorted(knots, x, side='right') - 1
+    mu = np.clip(mu, order, ncoef - 1)
+
+    basis = np.zeros((len(x), order + 1))
+    basis[:, 0] = 1.
+    left = [None]
+    right = [None]
+    for d in range(1, order + 1):
+        left.append(x - knots[mu + 1 - d])
+        right.append(knots[mu + d] - x)
+        saved = np.zeros(len(x))
+        for r in range(d):
+            temp = basis[:, r] / (right[r + 1] + left[d - r])
+            basis[:, r] = saved + right[r + 1] * temp
+            saved = left[d - r] * temp
+        basis[:, d] = saved
+
+    return mu - order, basis
+
+
+def _BandedSpline(first, basis, flux, weight, ncoef):
+    '''
+    Solve the weighted least squares for the spline coefficients, w/ the
+    banded normal equations (B^T W B) c = B^T W y, via banded Cholesky.
+    '''
+    npts, nb = basis.shape
+    # upper form of solveh_banded: ab[u + i - j, j] = M[i, j]
+    ab = np.zeros((nb, ncoef))
+    wb = basis * weight[:, None]
+    for r in range(nb):
+        for s in range(r, nb):
+            ab[nb - 1 + r - s] += np.bincount(first + s, wb[:, r] * basis[:, s],
+                                              minlength=ncoef)
+    rhs = np.bincount((first[:, None] + np.arange(nb)).ravel(),
+                      (wb * flux[:, None]).ravel(), minlength=ncoef)
+    return solveh_banded(ab, rhs, check_finite=False)
+
+
+def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=False,
+               weight=None, tol=None, returnweight=False, engine='banded', wtol=1e-9):
     '''
     IRLS = Iterative Re-weight Least Squares
     Do a multi-pass, weighted spline fit, with iterative down-weighting of
@@ -524,7 +1132,9 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
     Originally described by DFM: https://github.com/dfm/untrendy
     Likley not adequately reproduced here.
 
-    uses scipy.interpolate.LSQUnivariateSpline
+    The default engine builds the B-spline basis once, and solves each pass
+    as a banded system. engine='fitpack' uses scipy's LSQUnivariateSpline
+    on every pass instead, which gives the same model.
 
     Parameters
     ----------
@@ -543,13 +1153,32 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
         the spline order to use (default is 3)
     debug : bool, optional
         used to print out troubleshooting things (default=False)
+    weight : 1-d numpy array, optional
+        the outlier down-weighting, Q / (chisq + Q), to start from, e.g.
+        as returned w/ returnweight=True by an earlier run on similar data
+        (default=None, i.e. all 1)
+    tol : float, optional
+        stop before numpass once the model changes by less than tol times
+        the errors between passes (default=None, always take numpass)
+    returnweight : bool, optional
+        if True, also return the final outlier down-weighting
+        (default=False)
+    engine : str, optional
+        'banded' (default) or 'fitpack'
+    wtol : float, optional
+        w/ the banded engine, stop once no down-weighting changes by more
+        than wtol between passes (default=1e-9)
 
     Returns
     -------
     the final spline model
+    If returnweight=True, (model, down-weighting)
     '''
 
-    weight = 1. / (error**2.0)
+    if weight is None:
+        weight = np.ones_like(error)
+    downweight = weight
+    weight = downweight / (error**2.0)
 
     knots = np.arange(np.nanmin(time) + ksep, np.nanmax(time) - ksep, ksep)
 
@@ -564,13 +1193,57 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
         plt.scatter(knots, knots*0. + np.median(flux))
         plt.show()
 
+    if engine == 'banded':
+        time = np.asarray(time, dtype='float')
+        flux = np.asarray(flux, dtype='float')
+        error = np.asarray(error, dtype='float')
+        if (not np.all(np.isfinite(time)) or not np.all(np.isfinite(flux)) or
+            not np.all(np.isfinite(weight)) or np.any(np.diff(time) < 0)):
+            # let LSQUnivariateSpline raise, as it always did
+            engine = 'fitpack'
+        else:
+            # same knot vector as LSQUnivariateSpline
+            t_all = np.concatenate(([time[0]] * (order + 1), knots,
+                                    [time[-1]] * (order + 1)))
+            ncoef = len(knots) + order + 1
+            first, basis = BSplineBasis(time, t_all, order=order)
+            cols = first[:, None] + np.arange(order + 1)
+
+    model = None
     for k in range(numpass):
-        spl = LSQUnivariateSpline(time, flux, knots, k=order, check_finite=True, w=weight)
-        # spl = UnivariateSpline(time, flux, w=weight, k=order, s=1)
-
-        chisq = ((flux - spl(time))**2.) / (error**2.0)
-
-        weight = Q / ((error**2.0) * (chisq + Q))
-
-    return spl(time)
+        if engine == 'banded':
+            # FITPACK weights the residuals by w, i.e. the squares by w**2
+            try:
+                coef = _BandedSpline(first, basis, flux, weight**2., ncoef)
+            except LinAlgError:
+                # e.g. a knot interval w/o data: LSQUnivariateSpline raises
+                engine = 'fitpack'
+        if engine == 'banded':
+            model_k = np.sum(basis * coef[cols], axis=1)
+        else:
+            spl = LSQUnivariateSpline(time, flux, knots, k=order, check_finite=True, w=weight)
+            # spl = UnivariateSpline(time, flux, w=weight, k=order, s=1)
+            model_k = spl(time)
+
+        chisq = ((flux - model_k)**2.) / (error**2.0)
+
+        downweight_k = Q / (chisq + Q)
+        weight = downweight_k / (error**2.0)
+
+        if ((tol is not None) and (model is not None) and
+            (np.nanmax(np.abs(model_k - model) / error) < tol)):
+            model = model_k
+            downweight = downweight_k
+            break
+        if ((engine == 'banded') and (model is not None) and
+            (np.nanmax(np.abs(downweight_k - downweight)) < wtol)):
+            model = model_k
+            downweight = downweight_k
+            break
+        model = model_k
+        downweight = downweight_k
+
+    if returnweight is True:
+        return model, downweight
+    return model
 
@@ -4,7 +4,7 @@ from scipy import stats
 from scipy.signal import wiener
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
-from aflare import aflare1
+from aflare import aflare1_fast
 from helper import chisq, ED
 
 
@@ -108,7 +108,7 @@ def FlareStats(lc, istart=-1, istop=-1,
     # print(len(flaretime)) # % ;
 
     try:
-        popt1, pcov = curve_fit(aflare1, np.array(flaretime), (flareflux-contline) / medflux, p0=pguess)
+        popt1, pcov = curve_fit(aflare1_fast, np.array(flaretime), (flareflux-contline) / medflux, p0=pguess)
     except ValueError:
         # tried to fit bad data, so just fill in with NaN's
         # shouldn't happen often
@@ -149,7 +149,7 @@ def FlareStats(lc, istart=-1, istop=-1,
     else:
         return params
 def FakeFlaresDist(std, nfake, ampl=(5e-1,5e2), dur=(5e-1,2e2),
-                   mode='hawley2014', scatter=False, debug=False):
+                   mode='hawley2014', scatter=False, debug=False, rng=None):
 
     '''
     Creates different distributions of fake flares to be injected into light curves.
@@ -170,6 +170,7 @@ def FakeFlaresDist(std, nfake, ampl=(5e-1,5e2), dur=(5e-1,2e2),
           default='hawley2014'
     scatter: saves a scatter plot of the distribution for the injected sample,
              default='False'
+    rng: numpy.random.Generator to draw from, default=None (use np.random)
 
     Returns:
     -------
@@ -180,10 +181,13 @@ def FakeFlaresDist(std, nfake, ampl=(5e-1,5e2), dur=(5e-1,2e2),
 
     '''
 
+    if rng is None:
+        rng = np.random
+
     if mode=='rand':
 
-        dur_fake =  (np.random.random(nfake) * (dur[1] - dur[0]) + dur[0])
-        ampl_fake = (np.random.random(nfake) * (ampl[1] - ampl[0]) + ampl[0])*std
+        dur_fake =  (rng.random(nfake) * (dur[1] - dur[0]) + dur[0])
+        ampl_fake = (rng.random(nfake) * (ampl[1] - ampl[0]) + ampl[0])*std
         lndur_fake = np.log10(dur_fake)
         lnampl_fake = np.log10(ampl_fake)
         dur_fake = dur_fake / 60. / 24.
@@ -197,9 +201,9 @@ def FakeFlaresDist(std, nfake, ampl=(5e-1,5e2), dur=(5e-1,2e2),
         alpha=2.                                        #estimated from fig. 10 in Hawley et al. 2014
         ampl=(np.log10(2.*std),np.log10(10000.*std))
 
-        lnampl_fake = (np.random.random(nfake) * (ampl[1] - ampl[0]) + ampl[0])
+        lnampl_fake = (rng.random(nfake) * (ampl[1] - ampl[0]) + ampl[0])
         lndur_fake=np.zeros(nfake, dtype='float')
-        rand=np.random.random(nfake)
+        rand=rng.random(nfake)
         dur_max = (1./alpha) * (lnampl_fake-c_range[0]) #log(tmax)
         dur_min = (1./alpha) * (lnampl_fake-c_range[1]) # log(tmin)
 
@@ -231,7 +235,7 @@ def FakeFlaresDist(std, nfake, ampl=(5e-1,5e2), dur=(5e-1,2e2),
 
     return dur_fake, ampl_fake
 
-def FakeCompleteness(dffake,fakefreq,iterations,display=False,file=''):
+def FakeCompleteness(dffake,fakefreq,iterations,display=False,file='',quiet=False):
     '''
     Construct a completeness curve for the fake injections.
     Parameters:
@@ -241,6 +245,12 @@ def FakeCompleteness(dffake,fakefreq,iterations,display=False,file=''):
     iterations
     display =False
     file =''
+    quiet =False, don't warn about too few injections
+
+    The recovered fraction is binned by the injected ED (ed_fake); the
+    lookup table of LookupCompleteness uses this same estimator. The
+    number of ED bins is the square root of the number of injected flares
+    in dffake (fakefreq and iterations are not used for it).
 
     Returns:
     --------------
@@ -248,13 +258,14 @@ def FakeCompleteness(dffake,fakefreq,iterations,display=False,file=''):
     ed90
 
     '''
-    nbins = max(8,int(np.rint(fakefreq * iterations)))
+    nbins = max(8,int(np.rint(np.sqrt(len(dffake)))))
     if nbins < 10:
-        print('Warning: Few injections, completeness of recovery unclear.\nTry increasing iterations.')
+        if quiet is False:
+            print('Warning: Few injections, completeness of recovery unclear.\nTry increasing iterations.')
         return -199,-199
     bins = np.linspace(0, dffake.ed_fake.max() + 1, nbins)
     binmids = np.concatenate(([0],(bins[1:]+bins[:-1])/2))
-    frac_recovered = dffake.rec_fake.groupby(np.digitize(dffake.ed_rec, bins)).mean()
+    frac_recovered = dffake.rec_fake.groupby(np.digitize(dffake.ed_fake, bins)).mean()
     frac_recovered.iloc[0] = 0 #add a zero intercept for aesthetics
     frac_recovered.sort_index(inplace=True) #helps plotting
     binmids = np.concatenate(([0],(bins[1:]+bins[:-1])/2)) #add a zero intercept for aesthetics
@@ -295,3 +306,95 @@ def FakeCompleteness(dffake,fakefreq,iterations,display=False,file=''):
 
         plt.close()
     return ed68, ed90
+
+
+def FakeCompletenessBoot(dffake, fakefreq, iterations, nboot=100, rng=None):
+    '''
+    Bootstrap the ED68/ED90 completeness limits of the fake injections,
+    resampling the injected flares with replacement.
+
+    Parameters:
+    -------------
+    dffake : DataFrame of fake flares, as from FakeFlares
+    fakefreq
+    iterations : number of injection iterations in dffake
+    nboot : number of bootstrap resamples (default=100)
+    rng : numpy.random.Generator (or RandomState) to resample with
+          (default=None, i.e. the global numpy.random state)
+
+    Returns:
+    --------------
+    ed68, ed90, ed68_err, ed90_err
+
+    The errors are the bootstrap standard deviations. They are np.inf if
+    the completeness limits are undefined in any resample (-99 or -199).
+    '''
+    if rng is None:
+        rng = np.random
+
+    ed68, ed90 = FakeCompleteness(dffake, fakefreq, iterations)
+    if (ed68 < 0) or (ed90 < 0):
+        return ed68, ed90, np.inf, np.inf
+
+    boot = np.zeros((nboot, 2))
+    for b in range(nboot):
+        irow = rng.choice(len(dffake), size=len(dffake))
+        boot[b] = FakeCompleteness(dffake.iloc[irow], fakefreq, iterations,
+                                   quiet=True)
+
+    if np.any(boot < 0):
+        return ed68, ed90, np.inf, np.inf
+
+    ed68_err, ed90_err = np.std(boot, axis=0)
+    return ed68, ed90, ed68_err, ed90_err
+
+
+def LookupCompleteness(table, std, dt, mode='davenport', mincount=100):
+    '''
+    Interpolate the ED68/ED90 completeness limits from a lookup table of
+    past fake flare injections, instead of injecting new ones.
+    The limits in each noise bin are those of FakeCompleteness on the
+    pooled injections, in the cadence bin of the light curve, and are
+    interpolated linearly in log noise level between the bin middles.
+
+    Parameters:
+    -------------
+    table : lookup table, as from postprocess.FakeLookupTable, or the
+            .npz file it was saved to
+    std : noise level of the light curve, in relative flux
+    dt : cadence of the light curve, in days
+    mode : detrending mode of the light curve (default='davenport')
+    mincount : minimum number of injections in a noise bin to use it
+               (default=100)
+
+    Returns:
+    --------------
+    ed68, ed90, or None if the light curve is not covered by the table
+    (other mode, cadence or noise level)
+    '''
+    if isinstance(table, str):
+        with np.load(table) as npz:
+            table = {k: npz[k] for k in npz.files}
+
+    if str(table['mode']) != mode:
+        return None
+
+    idt = np.searchsorted(table['dt_edges'], dt) - 1
+    if (idt < 0) or (idt >= len(table['dt_edges']) - 1):
+        return None
+
+    ed68 = table['ed68'][:, idt]
+    ed90 = table['ed90'][:, idt]
+    ok = (table['nfake'][:, idt] >= mincount) & (ed68 > 0) & (ed90 > 0)
+    if ok.sum() == 0:
+        return None
+
+    # covered if inside the edges of the usable noise bins
+    edges = table['std_edges']
+    if (std < edges[:-1][ok][0]) or (std > edges[1:][ok][-1]):
+        return None
+
+    logstd = np.log10(np.sqrt(edges[1:] * edges[:-1]))[ok]
+    ed68 = 10**np.interp(np.log10(std), logstd, np.log10(ed68[ok]))
+    ed90 = 10**np.interp(np.log10(std), logstd, np.log10(ed90[ok]))
+    return ed68, ed90
@@ -1,4 +1,7 @@
+import os
+import json
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 def chisq(data, error, model):
@@ -79,6 +82,238 @@ def ED(start, stop, lc, err=False, residual_given=False):
     else:
         return ed
 
+def MultiED(istart, istop, lc, err=False):
+
+    '''
+    Returns the equivalent durations of many flare events at once, each
+    found within indices [istart, istop], as ED() does for one event.
+    Sums each window w/ np.add.reduceat instead of a loop, so (as in ED)
+    a NaN only affects the events whose window it is in.
+
+    Parameters:
+    --------------
+    istart : array of ints
+        start time indices of the flare events
+    istop : array of ints
+        end time indices of the flare events
+    lc : pandas DataFrame
+        light curve with columns ['time','flux_model','flux','error']
+    err: False or bool
+        If True will compute uncertainties on the EDs
+
+    Returns:
+    --------------
+    ed : numpy array
+        equivalent durations in seconds
+    ederr : numpy array
+        uncertainties in seconds
+    '''
+
+    istart = np.asarray(istart, dtype='int')
+    # ED() divides by the requested number of points in the error...
+    nreq = np.asarray(istop, dtype='int') - istart + 1
+    # ...but like .iloc, doesn't run off the end of the light curve
+    istop = np.minimum(np.asarray(istop, dtype='int'), len(lc) - 1)
+    if len(istart) == 0:
+        ed = np.zeros(0)
+        return (ed, ed.copy()) if err == True else ed
+
+    residual = (lc.flux - lc.flux_model).values
+    time = lc.time.values * 60. * 60. * 24.
+
+    # the trapezoids between neighbouring points, summed from istart up to
+    # istop in each window. The 0 at the end keeps the indices in range
+    trap = np.append((residual[1:] + residual[:-1]) / 2. * (time[1:] - time[:-1]), 0.)
+    ed = np.add.reduceat(trap, np.ravel(np.column_stack((istart, istop))))[::2]
+    # reduceat gives trap[istart] for empty windows
+    ed[istop <= istart] = 0.
+
+    if err == True:
+        chi = np.append(((lc.flux - lc.flux_model) / lc.error).values**2., 0.)
+        npts = istop - istart + 1
+        flare_chisq = np.add.reduceat(chi, np.ravel(np.column_stack((istart, istop + 1))))[::2] / npts
+        ederr = np.sqrt(ed**2 / nreq / flare_chisq)
+        return ed, ederr
+    else:
+        return ed
+
+def AppendRecord(outfile, row, binary=False):
+
+    '''
+    Append one record to an append-only log file, with a single write()
+    to a file opened in O_APPEND mode. Records from many processes writing
+    to the same log at once don't clobber each other, and the cost does
+    not grow with the size of the log.
+
+    Parameters:
+    --------------
+    outfile : str
+        the log file
+    row : dict
+        the record. For binary=True, the values must all be numbers, and
+        every record in the file needs the same keys, in the same order
+    binary : False or bool
+        If False, write a line of JSON (i.e. JSON Lines format).
+        If True, write the values as little-endian 8-byte floats
+    '''
+
+    if binary is True:
+        data = np.asarray(list(row.values()), dtype='<f8').tobytes()
+    else:
+        data = (json.dumps(row) + '\n').encode()
+
+    fd = os.open(outfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return
+
+
+def ReadRecords(outfile, columns=None, binary=False):
+
+    '''
+    Read all the records of a log written by AppendRecord, in one pass.
+
+    Parameters:
+    --------------
+    outfile : str
+        the log file
+    columns : list of str
+        the keys of the records. Required if binary=True
+    binary : False or bool
+        If the log was written w/ binary=True
+
+    Returns:
+    --------------
+    pandas DataFrame with one row per record
+    '''
+
+    if binary is True:
+        data = np.fromfile(outfile, dtype='<f8')
+        # ignore a partly written record at the end
+        nrec = len(data) // len(columns)
+        return pd.DataFrame(data[:nrec * len(columns)].reshape(nrec, len(columns)),
+                            columns=columns)
+    else:
+        # keep the values as they were written, e.g. IDs stay strings
+        df = pd.read_json(outfile, lines=True, dtype=False, convert_dates=False)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+
+class ColumnBuffer(object):
+    '''
+    A growable table of columns, to collect results row by row (or block
+    by block) without the quadratic cost of DataFrame.append. The numpy
+    column arrays double in size when full, and the DataFrame is only
+    made once at the end, with to_frame().
+
+    Examples
+    --------
+    >>> buf = ColumnBuffer(['istart', 'ed'])
+    >>> buf.append({'istart':10, 'ed':3.2})
+    >>> buf.extend({'istart':[20, 30], 'ed':[1.1, 0.5]})
+    >>> df = buf.to_frame()
+    '''
+
+    def __init__(self, columns=None, capacity=64):
+        '''
+        Parameters
+        ----------
+        columns : list of str, optional
+            the column names, in order. If not given, they are taken from
+            the first row or block added
+        capacity : int, optional
+            the initial number of rows to allocate (Default is 64)
+        '''
+        self.columns = None if columns is None else list(columns)
+        self._data = {}
+        self._size = 0
+        self._capacity = max(1, int(capacity))
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, nrows):
+        # make room for nrows more rows, doubling the arrays as needed
+        need = self._size + nrows
+        if need <= self._capacity:
+            return
+        while self._capacity < need:
+            self._capacity *= 2
+        for key, col in self._data.items():
+            new = np.empty(self._capacity, dtype=col.dtype)
+            new[:self._size] = col[:self._size]
+            self._data[key] = new
+
+    def _store(self, key, values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'USM':
+            # strings & dates are kept as python objects, like pandas does
+            values = values.astype('object')
+
+        if key not in self._data:
+            self._data[key] = np.empty(self._capacity, dtype=values.dtype)
+        elif not np.can_cast(values.dtype, self._data[key].dtype, casting='same_kind'):
+            self._data[key] = self._data[key].astype(np.result_type(values.dtype,
+                                                                    self._data[key].dtype))
+
+        self._data[key][self._size:self._size + len(values)] = values
+
+    def extend(self, block):
+        '''
+        Add many rows at once. Columns missing from the block are filled
+        w/ NaN, and new columns in it are added, filled w/ NaN for the rows
+        before (as in pandas.concat).
+
+        Parameters
+        ----------
+        block : dict of equal length arrays, or a pandas DataFrame
+        '''
+        if isinstance(block, pd.DataFrame):
+            block = {key: block[key].values for key in block.columns}
+        if self.columns is None:
+            self.columns = list(block.keys())
+
+        nrows = len(np.atleast_1d(block[list(block.keys())[0]])) if len(block) > 0 else 0
+        self._reserve(nrows)
+        for key in block:
+            if key not in self.columns:
+                self.columns.append(key)
+                self._data[key] = np.full(self._capacity, np.nan)
+        for key in self.columns:
+            if key in block:
+                self._store(key, np.atleast_1d(block[key]))
+            else:
+                self._store(key, np.full(nrows, np.nan))
+        self._size += nrows
+
+    def append(self, row):
+        '''
+        Add one row.
+
+        Parameters
+        ----------
+        row : dict, or list of values in the order of the columns
+        '''
+        if not isinstance(row, dict):
+            row = dict(zip(self.columns, row))
+        self.extend({key: [value] for key, value in row.items()})
+
+    def to_frame(self):
+        '''
+        Returns
+        -------
+        pandas DataFrame with all the rows added so far
+        '''
+        if self.columns is None:
+            return pd.DataFrame()
+        return pd.DataFrame({key: self._data[key][:self._size] for key in self._data},
+                            columns=self.columns)
+
+
 def Plot(lc, ax, istart=None,istop=None,onlybit=None):
 
     '''
@@ -1,5 +1,9 @@
 import numpy as np
+import pandas as pd
 import os
+import glob
+from helper import ReadRecords
+from fake import FakeCompleteness
 
 
 def PostCondor(flares='fakes.lis', outfile='condorout.dat'):
@@ -131,6 +135,130 @@ def PostCondor(flares='fakes.lis', outfile='condorout.dat'):
 
     return
 
+def MergeFlareList(shardir='flarelist', outfile='flarelist.csv', compact=False):
+    '''
+    Build the consolidated list of the number of flares per light curve,
+    from the per-process shards that RunLC appends to.
+
+    Run in the working directory of the RunLC jobs, e.g. after a Condor run.
+
+    Parameters
+    ----------
+    shardir : str, optional
+        the directory holding the shards (Default is 'flarelist')
+    outfile : str, optional
+        the csv file to write the merged list to (Default is 'flarelist.csv')
+    compact : bool, optional
+        If True, replace all the shards w/ one merged shard, to keep the
+        number of files down. Only do this when no jobs are running!
+        (Default is False)
+
+    Returns
+    -------
+    the merged list, as a DataFrame
+    '''
+    shards = sorted(glob.glob(os.path.join(shardir, '*.jsonl')))
+    if len(shards) == 0:
+        print('No flare list shards found in ' + shardir)
+        return pd.DataFrame()
+
+    dfout = pd.concat([ReadRecords(f) for f in shards], ignore_index=True)
+    dfout.to_csv(outfile)
+
+    if compact is True:
+        merged = os.path.join(shardir, 'merged.jsonl')
+        tmp = merged + '.tmp'
+        dfout.to_json(tmp, orient='records', lines=True)
+        # swap in the merged shard before removing the others, so the
+        # records are never missing from shardir
+        os.replace(tmp, merged)
+        for f in shards:
+            if f != merged:
+                os.remove(f)
+
+    return dfout
+
+
+def FakeLookupTable(pattern='*_all_fakes.csv', outfile='fake_lookup.npz',
+                    mode='davenport', nstd=12, ndt=4, minspan=0.1):
+    '''
+    Pool the fake flare injections of past RunLC jobs in to a lookup table
+    of the ED68/ED90 completeness limits, gridded over noise level and
+    cadence. Use it to skip the injections, see RunLC(lookup=...)
+
+    The limits in each cell are computed from the pooled injections with
+    fake.FakeCompleteness, the same estimator RunLC uses on fresh ones, so
+    one cell spanning all the pooled runs reproduces FakeCompleteness on
+    them exactly.
+
+    The injected flare duration is not a grid axis: FakeFlares draws the
+    FWHM from the amplitude, so it is tied to the ED, and the limits are
+    averaged over it the same way as in FakeCompleteness.
+
+    Only pool runs that used the same detrending mode! Files written
+    before the noise and cadence columns were added are skipped.
+
+    Parameters
+    ----------
+    pattern : str, optional
+        glob pattern of the *_all_fakes.csv files to pool
+        (Default is '*_all_fakes.csv')
+    outfile : str, optional
+        the .npz file to write the table to (Default is 'fake_lookup.npz')
+    mode : str, optional
+        the detrending mode of the pooled runs, stored w/ the table
+        (Default is 'davenport')
+    nstd, ndt : int, optional
+        the number of log-spaced bins in noise level (relative flux)
+        and cadence (days)
+    minspan : float, optional
+        the minimum width of each grid, in dex. Narrower grids, e.g. when
+        all the light curves have the same cadence, are widened to it
+        around their middle (Default is 0.1)
+
+    Returns
+    -------
+    the table, as a dict w/ the bin edges (std_edges, dt_edges), the
+    number of injected flares (nfake) and the ED68/ED90 limits (ed68,
+    ed90; -199 where FakeCompleteness had too few) per cell, and the mode
+    '''
+    cols = ['std_fake', 'dt_fake', 'ed_fake', 'rec_fake']
+    files = sorted(glob.glob(pattern))
+    dfs = []
+    for f in files:
+        df = pd.read_csv(f)
+        if not set(cols).issubset(df.columns):
+            print('Skipping ' + f + ', no noise/cadence columns')
+            continue
+        dfs.append(df[cols])
+    if len(dfs) == 0:
+        print('No fake flares found in ' + pattern)
+        return {}
+
+    df = pd.concat(dfs, ignore_index=True)
+    df = df[(df.std_fake > 0) & (df.dt_fake > 0) & (df.ed_fake > 0)]
+    sample = np.log10(df[cols[:2]].values)
+
+    # pad the edges a bit, so the extremes fall inside the grid
+    pad = np.maximum(1e-6, (minspan - np.ptp(sample, axis=0)) / 2.)
+    edges = [np.logspace(lo - p, hi + p, n + 1) for lo, hi, p, n in
+             zip(sample.min(axis=0), sample.max(axis=0), pad, (nstd, ndt))]
+
+    nfake = np.zeros((nstd, ndt))
+    ed68 = np.full((nstd, ndt), -199.)
+    ed90 = np.full((nstd, ndt), -199.)
+    istd = np.digitize(sample[:, 0], np.log10(edges[0])) - 1
+    idt = np.digitize(sample[:, 1], np.log10(edges[1])) - 1
+    for (i, j), dfc in df.groupby([istd, idt]):
+        nfake[i, j] = len(dfc)
+        ed68[i, j], ed90[i, j] = FakeCompleteness(dfc, 0, 0, quiet=True)
+
+    table = {'std_edges': edges[0], 'dt_edges': edges[1],
+             'nfake': nfake, 'ed68': ed68, 'ed90': ed90, 'mode': mode}
+    np.savez(outfile, **table)
+    return table
+
+
 if __name__ == "__main__":
     # import sys
     PostCondor()
@@ -0,0 +1,117 @@
+'''
+Check the faster detrending against the code it replaced, and time them.
+
+Run from the appaloosa directory:
+    python test_suite/check_detrend.py
+
+Compares, on synthetic light curves in long (30 min) and short (1 min)
+cadence, w/ spots, flares and a few NaN's:
+    MultiBoxcar (index based)  vs. the pandas version it replaced: the
+                               same kept points and the same model
+    IRLSSpline(engine='banded') vs. engine='fitpack': the largest
+                               difference of the models, in units of
+                               the errors, w/ the default wtol and w/
+                               wtol=0 (all the passes, as fitpack)
+'''
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import detrend
+
+
+def MultiBoxcarPandas(time, flux, error, numpass=3, kernel=2.0,
+                      sigclip=5, pcentclip=5, returnindx=False):
+    '''
+    MultiBoxcar as it was before the passes were run on an index, w/ a
+    pandas rolling median on every pass. The reference for the checks below.
+    '''
+    flux_i = pd.DataFrame({'flux':flux,'error_i':error,'time_i':time})
+    time_i = np.array(time)
+    exptime = np.nanmedian(time_i[1:]-time_i[:-1])
+
+    nptsmooth = int(kernel/24.0 / exptime)
+    if (nptsmooth < 4):
+        nptsmooth = 4
+
+    for k in range(0, numpass):
+        flux_i['flux_i_sm'] = flux_i.flux.rolling(nptsmooth, center=True).median()
+        flux_i = flux_i.dropna(how='any')
+
+        if (flux_i.shape[0] > 1):
+            flux_i['diff_k'] = flux_i.flux-flux_i.flux_i_sm
+            lims = np.nanpercentile(flux_i.diff_k, (pcentclip, 100-pcentclip))
+            ok = np.logical_or((np.abs(flux_i.diff_k / flux_i.error_i) < sigclip),
+                               (lims[0] < flux_i.diff_k) * (flux_i.diff_k < lims[1]))
+            flux_i = flux_i[ok]
+
+    flux_sm = np.interp(time, flux_i.time_i, flux_i.flux)
+
+    if returnindx is False:
+        return flux_sm
+    else:
+        return np.array(flux_i.index.values, dtype='int')
+
+
+def MakeLC(npts, dt, seed=42):
+    '''
+    A synthetic light curve w/ a spot modulation, flares and a few NaN's
+    '''
+    rng = np.random.default_rng(seed)
+    time = np.sort(np.arange(npts) * dt + rng.normal(0., dt * 1e-3, npts))
+    flux = 1000. + 5. * np.sin(2. * np.pi * time / 3.1) + rng.normal(size=npts)
+    iflare = rng.integers(0, npts, npts // 50)
+    flux[iflare] += rng.uniform(5., 50., len(iflare))
+    error = np.ones(npts)
+    fnan = flux.copy()
+    fnan[rng.integers(0, npts, 3)] = np.nan
+    return time, flux, fnan, error
+
+
+def Timed(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+if __name__ == '__main__':
+    allok = True
+
+    for name, npts, dt in (('long cadence', 4000, 1/48.),
+                           ('short cadence', 40000, 1/1440.)):
+        t, f, fnan, e = MakeLC(npts, dt)
+        print('{}, {} points'.format(name, npts))
+
+        for kw in (dict(kernel=2.0, numpass=2), dict(kernel=0.3), dict(kernel=10.)):
+            for flux, nans in ((f, ''), (fnan, ' w/ NaNs')):
+                ref, tref = Timed(MultiBoxcarPandas, t, flux, e, returnindx=True, **kw)
+                new, tnew = Timed(detrend.MultiBoxcar, t, flux, e, returnindx=True, **kw)
+                ok = (np.array_equal(ref, new) and
+                      np.array_equal(MultiBoxcarPandas(t, flux, e, **kw),
+                                     detrend.MultiBoxcar(t, flux, e, **kw)))
+                allok &= ok
+                print('  MultiBoxcar {}{}: match = {}. pandas {:.3f}s, index {:.3f}s (x{:.1f})'
+                      .format(kw, nans, ok, tref, tnew, tref / tnew))
+
+        # as ModelLC calls it
+        ksep = (t.max() - t.min()) / npts * 10.
+        ref, tref = Timed(detrend.IRLSSpline, t, f, e, numpass=20, ksep=ksep,
+                          engine='fitpack')
+        new, tnew = Timed(detrend.IRLSSpline, t, f, e, numpass=20, ksep=ksep,
+                          engine='banded')
+        diff = np.max(np.abs(new - ref) / e)
+        # w/o stopping early on the down-weighting, only the solvers differ
+        exact = detrend.IRLSSpline(t, f, e, numpass=20, ksep=ksep, engine='banded',
+                                   wtol=0.)
+        dexact = np.max(np.abs(exact - ref) / e)
+        ok = (diff < 1e-6) and (dexact < 1e-10)
+        allok &= ok
+        print('  IRLSSpline: max |banded - fitpack| / error = {:.1e} ({:.1e} w/ wtol=0). '
+              'fitpack {:.3f}s, banded {:.3f}s (x{:.1f})'
+              .format(diff, dexact, tref, tnew, tref / tnew))
+
+    print('All match' if allok else 'MISMATCH')
+    sys.exit(0 if allok else 1)
@@ -0,0 +1,173 @@
+'''
+Check that the vectorized flare finders give the same flares as the
+original FINDflare loop, and time them.
+
+Run from the appaloosa directory:
+    python test_suite/check_findflare.py
+
+Compares, on a synthetic light curve w/ flares, NaN's and several
+segments:
+    FINDflare       vs. the loop (plain, avg_std=True, returnbinary=True)
+    FINDflareBatch  vs. the loop on each segment
+    FINDflareStream vs. the loop, fed in chunks
+    FINDflareSweep  vs. the loop for each (N1, N2, N3)
+and then FINDflare and FINDflareBatch vs. the loop on 1M points, the
+size of a short cadence light curve over several quarters.
+'''
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from appaloosa import FINDflare, FINDflareBatch, FINDflareStream, FINDflareSweep
+from aflare import aflare_batch
+
+
+def FINDflareLoop(flux, error, N1=3, N2=1, N3=3, avg_std=False, std_window=7,
+                  returnbinary=False):
+    '''
+    FINDflare as it was before it was vectorized, w/ the reverse loop
+    over the data. The reference for the checks below.
+    '''
+    med_i = np.nanmedian(flux)
+    if avg_std is False:
+        sig_i = np.nanstd(flux)
+    else:
+        sig_i = np.nanmedian(pd.Series(flux).rolling(std_window, center=True).std())
+
+    ca = flux - med_i
+    cb = np.abs(flux - med_i) / sig_i
+    cc = np.abs(flux - med_i - error) / sig_i
+
+    ctmp = np.where((ca > 0) & (cb > N1) & (cc > N2))
+
+    cindx = np.zeros_like(flux)
+    cindx[ctmp] = 1
+
+    ConM = np.zeros_like(flux)
+    for k in range(2, len(flux)):
+        ConM[-k] = cindx[-k] * (ConM[-(k-1)] + cindx[-k])
+
+    istart_i = np.where((ConM[1:] >= N3) &
+                        (ConM[0:-1] - ConM[1:] < 0))[0] + 1
+    istop_i = istart_i + (ConM[istart_i] - 1)
+
+    istart_i = np.array(istart_i, dtype='int')
+    istop_i = np.array(istop_i, dtype='int')
+
+    if returnbinary is False:
+        return istart_i, istop_i
+    else:
+        bin_out = np.zeros_like(flux, dtype='int')
+        for k in range(len(istart_i)):
+            bin_out[istart_i[k]:istop_i[k]+1] = 1
+        return bin_out
+
+
+def MakeLC(npts=50000, nseg=8, nflare=200, seed=42):
+    '''
+    A synthetic light curve (relative flux) w/ flares and a few NaN's,
+    and the boundaries of nseg segments.
+    '''
+    rng = np.random.default_rng(seed)
+    time = np.arange(npts) / 48.
+    flux = rng.normal(0., 1e-3, npts)
+    flux += aflare_batch(time, rng.uniform(time[0], time[-1], nflare),
+                         rng.uniform(0.01, 0.1, nflare),
+                         10**rng.uniform(-2.5, -1., nflare))
+    flux[rng.integers(0, npts, npts // 1000)] = np.nan
+    error = np.full(npts, 1e-3)
+    offsets = np.linspace(0, npts, nseg + 1).astype('int')
+    return flux, error, offsets
+
+
+def Same(a, b):
+    return all(np.array_equal(x, y) for x, y in zip(a, b))
+
+
+def Timed(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+if __name__ == '__main__':
+    flux, error, offsets = MakeLC()
+    allok = True
+
+    # the single light curve
+    for kw in (dict(), dict(avg_std=True), dict(N2=4, avg_std=True)):
+        ref, tref = Timed(FINDflareLoop, flux, error, **kw)
+        new, tnew = Timed(FINDflare, flux, error, **kw)
+        binok = np.array_equal(FINDflareLoop(flux, error, returnbinary=True, **kw),
+                               FINDflare(flux, error, returnbinary=True, **kw))
+        ok = Same(ref, new) and binok
+        allok &= ok
+        print('FINDflare {}: {} flares, match = {}. loop {:.3f}s, vectorized {:.4f}s (x{:.0f})'
+              .format(kw, len(ref[0]), ok, tref, tnew, tref / tnew))
+
+    # many segments at once
+    for kw in (dict(), dict(avg_std=True)):
+        ref, tref = Timed(lambda: [FINDflareLoop(flux[le:ri], error[le:ri], **kw)
+                                   for le, ri in zip(offsets[:-1], offsets[1:])])
+        ref = (np.concatenate([r[0] + le for r, le in zip(ref, offsets)]),
+               np.concatenate([r[1] + le for r, le in zip(ref, offsets)]))
+        new, tnew = Timed(FINDflareBatch, flux, error, offsets, **kw)
+        ok = Same(ref, new[:2])
+        allok &= ok
+        print('FINDflareBatch {}: {} flares in {} segments, match = {}. loop {:.3f}s, batch {:.4f}s (x{:.0f})'
+              .format(kw, len(ref[0]), len(offsets) - 1, ok, tref, tnew, tref / tnew))
+
+    # in chunks, w/ the statistics of the whole light curve
+    ref = FINDflareLoop(flux, error)
+    for chunk in (97, 1000, len(flux)):
+        state = None
+        new = ([], [])
+        for i0 in range(0, len(flux), chunk):
+            istart, istop, state = FINDflareStream(flux[i0:i0 + chunk], error[i0:i0 + chunk],
+                                                   state=state, med=np.nanmedian(flux),
+                                                   sig=np.nanstd(flux))
+            new[0].append(istart)
+            new[1].append(istop)
+        istart, istop, state = FINDflareStream([], [], state=state, final=True)
+        new = (np.concatenate(new[0] + [istart]), np.concatenate(new[1] + [istop]))
+        ok = Same(ref, new)
+        allok &= ok
+        print('FINDflareStream, chunks of {}: match = {}'.format(chunk, ok))
+
+    # the threshold grid
+    N1, N2, N3 = (2, 3, 4), (0, 1, 3), (1, 3, 5)
+    (counts, flares), tnew = Timed(FINDflareSweep, flux, error, N1=N1, N2=N2, N3=N3)
+    t0 = time.time()
+    ok = True
+    for key in flares:
+        ok &= Same(FINDflareLoop(flux, error, N1=key[0], N2=key[1], N3=key[2]), flares[key])
+    tref = time.time() - t0
+    allok &= ok
+    print('FINDflareSweep, {} combinations: match = {}. loop {:.3f}s, sweep {:.4f}s (x{:.0f})'
+          .format(len(flares), ok, tref, tnew, tref / tnew))
+
+    # the big light curve
+    flux, error, offsets = MakeLC(npts=1000000, nseg=100, nflare=4000)
+    for kw in (dict(), dict(avg_std=True)):
+        ref, tref = Timed(FINDflareLoop, flux, error, **kw)
+        new, tnew = Timed(FINDflare, flux, error, **kw)
+        ok = Same(ref, new)
+        allok &= ok
+        print('FINDflare {}, 1M points: {} flares, match = {}. loop {:.3f}s, vectorized {:.3f}s (x{:.1f})'
+              .format(kw, len(ref[0]), ok, tref, tnew, tref / tnew))
+
+    ref, tref = Timed(lambda: [FINDflareLoop(flux[le:ri], error[le:ri])
+                               for le, ri in zip(offsets[:-1], offsets[1:])])
+    ref = (np.concatenate([r[0] + le for r, le in zip(ref, offsets)]),
+           np.concatenate([r[1] + le for r, le in zip(ref, offsets)]))
+    new, tnew = Timed(FINDflareBatch, flux, error, offsets)
+    ok = Same(ref, new[:2])
+    allok &= ok
+    print('FINDflareBatch, 1M points: {} flares in {} segments, match = {}. loop {:.3f}s, batch {:.3f}s (x{:.1f})'
+          .format(len(ref[0]), len(offsets) - 1, ok, tref, tnew, tref / tnew))
+
+    print('All match' if allok else 'MISMATCH')
+    sys.exit(0 if allok else 1)